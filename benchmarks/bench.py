@@ -0,0 +1,333 @@
+# coding: utf-8
+"""
+Benchmarks of fly match, alter, convert and process paths.
+
+Run all benchmarks and write machine-readable results:
+
+    python benchmarks/bench.py run --pipes 10,100,1000 --output before.json
+
+Compare two runs (ratio > 1 means second run is faster):
+
+    python benchmarks/bench.py compare before.json after.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from copy import copy
+from datetime import datetime
+
+path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, path)
+
+from fly import Pipe, ObjectPipe, Converter
+from fly.stats import timer
+
+
+WORDS = [
+    "github", "bitbucket", "fork", "please", "merge", "request", "alert",
+    "critical", "error", "info", "daemon", "mail", "status", "python"
+]
+
+STRING_OPERATORS = [
+    "exact", "iexact", "startswith", "istartswith", "endswith",
+    "contains", "icontains", "regex"
+]
+
+
+class Message(object):
+    """
+    Object with attributes of message dictionary for ObjectPipe.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def make_messages(count, users, seed=0):
+    """
+    Return list of synthetic chat messages.
+    """
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        messages.append({
+            "username": "user%d" % rnd.randrange(users),
+            "text": " ".join(rnd.choice(WORDS) for _ in range(8)),
+            "created": "%02d:%02d:%02d" % (
+                rnd.randrange(24), rnd.randrange(60), rnd.randrange(60)),
+            "date": "2013-%02d-%02d 12:00" % (
+                rnd.randrange(1, 13), rnd.randrange(1, 28)),
+            "status": rnd.randrange(5),
+            "repeats": rnd.randrange(1000),
+            "tags": [rnd.choice(WORDS) for _ in range(2)]
+        })
+    return messages
+
+
+def make_string_pipe(rnd, users):
+    operator = rnd.choice(STRING_OPERATORS)
+    word = rnd.choice(WORDS)
+    if operator == "regex":
+        condition = {"pattern": word, "method": "search"}
+    elif operator in ("startswith", "istartswith", "endswith"):
+        condition = word[:3]
+    else:
+        condition = word
+    return {
+        "match": {
+            "username": {"conditions": [["exact", "user%d" % rnd.randrange(users)]]},
+            "text": {"conditions": [[operator, condition]]}
+        },
+        "alter": {
+            "replace": {"text": {"value": word, "replacement": word.upper()}},
+            "incr": {"repeats": {"value": 1}}
+        }
+    }
+
+
+def make_datetime_pipe(rnd, users):
+    return {
+        "mode": "or",
+        "match": {
+            "created": {
+                "mode": "or",
+                "conditions": [
+                    ["lte", "%02d:00:00" % rnd.randrange(12)],
+                    ["gte", "%02d:00:00" % rnd.randrange(12, 24)]
+                ],
+                "type": "time",
+                "format": "%H:%M:%S"
+            },
+            "date": {
+                "conditions": [["gte", "2013-%02d-01 00:00" % rnd.randrange(1, 13)]],
+                "type": "datetime"
+            }
+        },
+        "alter": {
+            "set": {"status": {"value": "0", "type": "int"}},
+            "append": {"tags": {"value": "late"}}
+        }
+    }
+
+
+def make_pipes(count, kind, users, seed=0):
+    """
+    Return list of synthetic pipes: kind is "string", "datetime" or "mixed".
+    """
+    rnd = random.Random(seed)
+    pipes = []
+    for _ in range(count):
+        if kind == "string" or (kind == "mixed" and rnd.random() < 0.5):
+            pipes.append(make_string_pipe(rnd, users))
+        else:
+            pipes.append(make_datetime_pipe(rnd, users))
+    return pipes
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(name, calls, **params):
+    """
+    Run every call of calls and return result with throughput and
+    latency percentiles in microseconds.
+    """
+    latencies = []
+    for call in calls:
+        started = timer()
+        call()
+        latencies.append(timer() - started)
+    total = sum(latencies)
+    latencies.sort()
+    result = {
+        "name": name,
+        "ops": len(latencies),
+        "seconds": total,
+        "ops_per_sec": len(latencies) / total if total else 0.0,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p90_us": percentile(latencies, 0.9) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6
+    }
+    result.update(params)
+    return result
+
+
+def bench_convert(messages):
+    converter = Converter()
+    values = []
+    for message in messages:
+        values.append((message["created"], "time", "%H:%M:%S"))
+        values.append((message["date"], "datetime", None))
+        values.append((str(message["status"]), "int", None))
+    return measure("convert", [
+        lambda args=args: converter.convert(*args) for args in values
+    ])
+
+
+def bench_check_match(messages, pipes, kind):
+    p = Pipe()
+    calls = []
+    for i, message in enumerate(messages):
+        pipe = pipes[i % len(pipes)]
+        calls.append(
+            lambda obj=message, pipe=pipe: p.check_match(
+                obj, pipe["match"], pipe.get("mode", "and")))
+    return measure("check_match", calls, kind=kind)
+
+
+def bench_apply_operators(messages, pipes, kind):
+    p = Pipe()
+    calls = []
+    for i, message in enumerate(messages):
+        section = dict(pipes[i % len(pipes)]["alter"])
+        calls.append(
+            lambda obj=copy(message), section=section: p.apply_operators(obj, section))
+    return measure("apply_operators", calls, kind=kind)
+
+
+def bench_apply(messages, pipes, kind, spec):
+    """
+    Pipe.apply with not compiled dict or json specifications.
+    """
+    p = Pipe()
+    if spec == "json":
+        pipes = [json.dumps(pipe) for pipe in pipes]
+    calls = []
+    for i, message in enumerate(messages):
+        calls.append(
+            lambda obj=copy(message), pipe=pipes[i % len(pipes)]: p.apply(obj, pipe))
+    return measure("apply", calls, kind=kind, spec=spec)
+
+
+def bench_process(messages, pipes, kind, pipe_class, spec, **options):
+    if spec == "json":
+        pipes = [json.dumps(pipe) for pipe in pipes]
+    started = timer()
+    p = pipe_class(pipes, **options)
+    load_seconds = timer() - started
+    if pipe_class is ObjectPipe:
+        objects = [Message(**copy(message)) for message in messages]
+    else:
+        objects = [copy(message) for message in messages]
+    name = "process"
+    if options:
+        name += "[%s]" % ",".join(sorted(options))
+    return measure(
+        name,
+        [lambda obj=obj: p.process(obj) for obj in objects],
+        kind=kind,
+        pipe_class=pipe_class.__name__,
+        spec=spec,
+        load_seconds=load_seconds
+    )
+
+
+def run(args):
+    pipe_counts = [int(count) for count in args.pipes.split(",")]
+    users = args.users
+    messages = make_messages(args.messages, users, seed=args.seed)
+    results = [bench_convert(messages)]
+    for kind in ("string", "datetime", "mixed"):
+        for count in pipe_counts:
+            pipes = make_pipes(count, kind, users, seed=args.seed)
+            params = {"pipes": count}
+            for result in (
+                bench_check_match(messages, pipes, kind),
+                bench_apply_operators(messages, pipes, kind),
+                bench_apply(messages, pipes, kind, "dict"),
+                bench_apply(messages, pipes, kind, "json"),
+                bench_process(messages, pipes, kind, Pipe, "dict"),
+                bench_process(messages, pipes, kind, Pipe, "json"),
+                bench_process(messages, pipes, kind, ObjectPipe, "dict"),
+                bench_process(messages, pipes, kind, Pipe, "dict", index=True),
+                bench_process(messages, pipes, kind, Pipe, "dict", reorder=True),
+            ):
+                result.update(params)
+                results.append(result)
+                if not args.quiet:
+                    print(describe(result), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "created": datetime.now().isoformat(),
+            "messages": args.messages,
+            "users": users,
+            "seed": args.seed
+        },
+        "results": results
+    }
+    dump = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dump)
+    else:
+        print(dump)
+
+
+def result_key(result):
+    return tuple(
+        (name, result[name]) for name in sorted(result)
+        if name not in ("ops", "seconds", "ops_per_sec", "load_seconds")
+        and not name.endswith("_us")
+    )
+
+
+def describe(result):
+    params = ", ".join(
+        "%s=%s" % (name, value) for name, value in result_key(result)
+        if name != "name"
+    )
+    return "%-24s %-50s %12.0f ops/s  p50 %8.1fus  p99 %8.1fus" % (
+        result["name"], params, result["ops_per_sec"],
+        result["p50_us"], result["p99_us"])
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    base_results = dict((result_key(r), r) for r in base["results"])
+    for result in new["results"]:
+        old = base_results.get(result_key(result))
+        if old is None or not old["ops_per_sec"]:
+            continue
+        print("%6.2fx  %s" % (result["ops_per_sec"] / old["ops_per_sec"], describe(result)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("--pipes", default="10,100,1000",
+                            help="comma separated numbers of pipes (up to 10000)")
+    run_parser.add_argument("--messages", type=int, default=1000)
+    run_parser.add_argument("--users", type=int, default=100,
+                            help="number of distinct usernames")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="file to write json results to")
+    run_parser.add_argument("--quiet", action="store_true")
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args)
+    elif args.command == "run":
+        run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from .pipes import Pipe, ObjectPipe, Logic, Match, Alter, Converter
\ No newline at end of file
+from .pipes import Pipe, ObjectPipe, Logic, Match, Alter, Converter, CompiledPipe
\ No newline at end of file
@@ -0,0 +1,191 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+asyncio streaming around Pipe. Requires Python 3.7+.
+"""
+import asyncio
+from collections import deque
+from time import perf_counter
+
+
+async def iterate(objects):
+    """
+    Turn ordinary iterable into async iterator.
+    """
+    for obj in objects:
+        yield obj
+
+
+async def collect(objects):
+    """
+    Return list of all objects of async iterator.
+    """
+    return [obj async for obj in objects]
+
+
+class AsyncPipe(object):
+    """
+    Apply Pipe (or ObjectPipe) to async stream of messages.
+
+    Messages are grouped into batches of batch_size (a smaller batch is
+    flushed if no message arrives during batch_timeout seconds). Without
+    executor every batch is processed in event loop which gets control
+    back between batches. With executor batches are processed in it and
+    at most concurrency batches are in flight - no more messages are taken
+    from stream until the oldest batch is done. Results are yielded in
+    order of messages.
+    """
+    def __init__(self, pipe, batch_size=100, batch_timeout=None,
+                 executor=None, concurrency=4, history_size=1000):
+        if concurrency < 1:
+            raise ValueError('concurrency must be positive')
+        self.pipe = pipe
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.executor = executor
+        self.concurrency = concurrency
+        self.batches = 0
+        self.objects = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        # latencies of recent batches to compute percentiles.
+        self.latencies = deque(maxlen=history_size)
+
+    def process_batch(self, batch):
+        """
+        Process list of messages synchronously and return list of results
+        with None for dropped messages.
+        """
+        return list(self.pipe.process_many(batch))
+
+    def record(self, batch, results, started):
+        latency = perf_counter() - started
+        self.batches += 1
+        self.objects += len(batch)
+        self.dropped += results.count(None)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.latencies.append(latency)
+
+    def metrics(self):
+        """
+        Return dictionary with batch latency metrics (in seconds).
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(value):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * value))]
+
+        return {
+            "batches": self.batches,
+            "objects": self.objects,
+            "dropped": self.dropped,
+            "avg_latency": self.total_latency / self.batches if self.batches else 0.0,
+            "max_latency": self.max_latency,
+            "p50_latency": percentile(0.5),
+            "p95_latency": percentile(0.95),
+            "p99_latency": percentile(0.99)
+        }
+
+    async def batches_of(self, messages):
+        """
+        Async generator of message batches.
+        """
+        batch = []
+        if self.batch_timeout is None:
+            async for message in messages:
+                batch.append(message)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        else:
+            iterator = messages.__aiter__()
+            next_message = None
+            try:
+                while True:
+                    if next_message is None:
+                        next_message = asyncio.ensure_future(
+                            iterator.__anext__())
+                    timeout = self.batch_timeout if batch else None
+                    done, _ = await asyncio.wait(
+                        [next_message], timeout=timeout)
+                    if not done:
+                        # stream is slow - do not keep messages waiting.
+                        yield batch
+                        batch = []
+                        continue
+                    task, next_message = next_message, None
+                    try:
+                        message = task.result()
+                    except StopAsyncIteration:
+                        break
+                    batch.append(message)
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+            finally:
+                if next_message is not None:
+                    # generator is closed early - stop waiting for stream.
+                    next_message.cancel()
+        if batch:
+            yield batch
+
+    async def process_stream(self, messages, skip_none=False):
+        """
+        Async generator which applies pipe to every message of async
+        iterator and yields results. Set skip_none to True to not yield
+        dropped messages.
+        """
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        batches = self.batches_of(messages)
+        try:
+            async for batch in batches:
+                started = perf_counter()
+                if self.executor is None:
+                    results = self.process_batch(batch)
+                    self.record(batch, results, started)
+                    for obj in results:
+                        if obj is not None or not skip_none:
+                            yield obj
+                    # let other tasks run between batches.
+                    await asyncio.sleep(0)
+                    continue
+                future = loop.run_in_executor(
+                    self.executor, self.process_batch, batch)
+                pending.append((batch, future, started))
+                while len(pending) >= self.concurrency:
+                    # backpressure - wait for the oldest batch.
+                    async for obj in self.results_of(
+                            pending.popleft(), skip_none):
+                        yield obj
+            while pending:
+                async for obj in self.results_of(pending.popleft(), skip_none):
+                    yield obj
+        finally:
+            # closed early - batches of stream are not waited for anymore.
+            await batches.aclose()
+
+    async def results_of(self, task, skip_none):
+        batch, future, started = task
+        results = await future
+        self.record(batch, results, started)
+        for obj in results:
+            if obj is not None or not skip_none:
+                yield obj
@@ -0,0 +1,93 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from collections import OrderedDict
+
+
+# marker for missing values.
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Bounded mapping which discards least recently used items when full.
+    Counts hits, misses and evictions to see if cache size is enough.
+    """
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return cached value for key and mark it as recently used.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value for key discarding least recently used item if
+        cache is full.
+        """
+        data = self._data
+        if data.pop(key, _missing) is _missing and len(data) >= self.maxsize:
+            try:
+                data.popitem(last=False)
+            except KeyError:
+                # emptied by another thread meanwhile.
+                pass
+            else:
+                self.evictions += 1
+        data[key] = value
+
+    def clear(self, reset=True):
+        """
+        Remove all items and reset counters (unless reset is False).
+        """
+        self._data.clear()
+        if not reset:
+            return
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+        Return dictionary with cache counters.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "maxsize": self.maxsize
+        }
@@ -0,0 +1,358 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from .pipes import (Logic, Match, Alter, Pipe, ObjectPipe, CompiledPipe,
+                    spec_hash, forget, _missing, _function, _is_default)
+
+
+# operators which generated code evaluates inline instead of calling
+# make_match_* method (unless method is overriden).
+match_templates = {
+    "make_match_exact": "%(value)s == %(condition)s",
+    "make_match_ne": "%(value)s != %(condition)s",
+    "make_match_gt": "%(value)s > %(condition)s",
+    "make_match_lt": "%(value)s < %(condition)s",
+    "make_match_gte": "%(value)s >= %(condition)s",
+    "make_match_lte": "%(value)s <= %(condition)s",
+    "make_match_startswith": "%(value)s.startswith(%(condition)s)",
+    "make_match_endswith": "%(value)s.endswith(%(condition)s)",
+    "make_match_contains": "%(value)s.find(%(condition)s) > -1",
+    "make_match_regex": "%(condition)s(%(value)s) is not None",
+    "make_match_between": "%(value)s in %(condition)s",
+    "make_match_not_between": "%(value)s not in %(condition)s"
+}
+
+# the same for make_alter_* methods.
+alter_templates = {
+    "make_alter_set": "%(alter)s",
+    "make_alter_incr": "%(value)s + %(alter)s"
+}
+
+# types of values which are written into source as literals.
+_literal_types = (bool, int, float, str, type(None))
+
+
+def _is_literal(value):
+    if type(value) is tuple:
+        return all(_is_literal(item) for item in value)
+    if type(value) not in _literal_types:
+        return False
+    if isinstance(value, float):
+        # nan and infinity have no literals.
+        return value == value and value - value == 0
+    return True
+
+
+class Generator(object):
+    """
+    Translate compiled pipe into source of functions match, alter and
+    apply with inlined operators, literal condition values and direct
+    dictionary (attribute) access. Other values are passed to functions
+    through namespace.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.owner = pipe.owner
+        self.namespace = {"_missing": _missing, "forget": forget}
+        self.lines = []
+
+    def name(self, prefix, value):
+        name = "%s%d" % (prefix, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def constant(self, value):
+        if _is_literal(value):
+            return repr(value)
+        return self.name("c", value)
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def path(self, key):
+        """
+        Return KeyPath of changed key or None.
+        """
+        paths = self.pipe.paths
+        return paths.get(key) if paths is not None else None
+
+    def get(self, key, path=None):
+        if path is not None:
+            return "%s(obj)" % self.name("path", path.get)
+        key = self.constant(key)
+        method = self.owner.get_object_value
+        if _is_default(method, Pipe):
+            return "obj.get(%s)" % key
+        if _is_default(method, ObjectPipe):
+            return "getattr(obj, %s, None)" % key
+        return "%s(obj, %s)" % (self.name("get", method), key)
+
+    def set(self, key, value):
+        path = self.path(key)
+        if path is not None:
+            return "%s(obj, %s, copy_on_write)" % (
+                self.name("set", path.set), value)
+        key = self.constant(key)
+        method = self.owner.set_object_key
+        if _is_default(method, Pipe):
+            return "obj[%s] = %s" % (key, value)
+        if _is_default(method, ObjectPipe):
+            return "setattr(obj, %s, %s)" % (key, value)
+        return "%s(obj, %s, %s)" % (self.name("set", method), key, value)
+
+    def delete(self, key):
+        path = self.path(key)
+        if path is not None:
+            return "%s(obj, copy_on_write)" % self.name("delete", path.delete)
+        key = self.constant(key)
+        method = self.owner.del_object_key
+        if _is_default(method, Pipe):
+            return "obj.pop(%s, None)" % key
+        return "%s(obj, %s)" % (self.name("delete", method), key)
+
+    def condition(self, condition, found=None):
+        """
+        Return expression of one condition. found is name of variable with
+        substrings found in object value for all pipes at once or None.
+        """
+        _operator, method, condition_value, lower, _found_key = condition
+        value = "lowered" if lower else "value"
+        condition_value = self.constant(condition_value)
+        name = getattr(_function(method), "__name__", None)
+        if name in match_templates and _is_default(method, Match):
+            expression = match_templates[name] % {
+                "value": value, "condition": condition_value}
+        else:
+            expression = "%s(%s, %s)" % (
+                self.name("match", method), value, condition_value)
+        if found is not None:
+            # substring search already done - the same as CompiledKey.check.
+            expression = "%s in %s[1] if %s is not None and %s in %s[0] " \
+                "else %s" % (condition_value, found, found, condition_value,
+                             found, expression)
+        return "(%s)" % expression
+
+    def conditions(self, key, indent):
+        """
+        Emit code which sets is_matched to result of key conditions.
+        Lowercased value is computed only if lowered condition is reached.
+        """
+        is_or = key.mode == Logic.OR
+        conditions = key.conditions
+        if not conditions:
+            self.emit(indent, "is_matched = %s" % (not is_or))
+            return
+        joiner = " or " if is_or else " and "
+        # found_key -> variable with substrings found for all pipes.
+        found = {}
+        for condition in conditions:
+            found_key = condition[4]
+            if found_key is not None and found_key not in found:
+                found[found_key] = "found%d" % len(found)
+                self.emit(indent, "%s = memo.get(%s) if memo is not None "
+                          "else None" % (found[found_key],
+                                         self.constant(found_key)))
+
+        def expression(conditions):
+            return joiner.join(
+                self.condition(condition, found.get(condition[4]))
+                for condition in conditions)
+
+        first_lower = len(conditions)
+        for position, condition in enumerate(conditions):
+            if condition[3]:
+                first_lower = position
+                break
+        before, after = conditions[:first_lower], conditions[first_lower:]
+        if before:
+            self.emit(indent, "is_matched = %s" % expression(before))
+            if not after:
+                return
+            self.emit(indent, "if not is_matched:" if is_or else "if is_matched:")
+            indent += 1
+        # lowercased value is shared with other pipes through memo.
+        lower_key = self.constant(key.lower_key)
+        self.emit(indent, "if memo is None:")
+        self.emit(indent + 1, "lowered = value.lower()")
+        self.emit(indent, "else:")
+        self.emit(indent + 1, "lowered = memo.get(%s, _missing)" % lower_key)
+        self.emit(indent + 1, "if lowered is _missing:")
+        self.emit(indent + 2, "lowered = memo[%s] = value.lower()" % lower_key)
+        self.emit(indent, "is_matched = %s" % expression(after))
+
+    def match(self):
+        pipe = self.pipe
+        is_or = pipe.mode == Logic.OR
+        self.emit(0, "def match(obj, memo=None):")
+        for key in pipe.keys:
+            self.emit(1, "# %r" % (key.key,))
+            self.emit(1, "value = %s" % self.get(key.key, key.path))
+            if key.convert is not None:
+                convert = self.name("convert", key.convert)
+                value_key = self.constant(key.value_key)
+                self.emit(1, "if memo is None:")
+                self.emit(2, "value = %s(value)" % convert)
+                self.emit(1, "else:")
+                self.emit(2, "converted = memo.get(%s, _missing)" % value_key)
+                self.emit(2, "if converted is _missing:")
+                self.emit(3, "converted = memo[%s] = %s(value)" % (
+                    value_key, convert))
+                self.emit(2, "value = converted")
+            self.conditions(key, 1)
+            if is_or:
+                self.emit(1, "if is_matched:")
+                self.emit(2, "return True")
+            else:
+                self.emit(1, "if not is_matched:")
+                self.emit(2, "return False")
+        self.emit(1, "return %s" % (not is_or))
+
+    def alter(self):
+        pipe = self.pipe
+        owner = self.owner
+        self.emit(0, "def alter(obj, memo=None, copy_on_write=False):")
+        if pipe.drop and not isinstance(pipe.drop, list) and \
+                _is_default(owner.alter_delete, Pipe):
+            # the whole object is dropped.
+            self.emit(1, "return None")
+            return
+        self.emit(1, "if copy_on_write:")
+        self.emit(2, "obj = %s(obj)" % self.name("copy", owner.copy_object))
+        if pipe.drop:
+            if isinstance(pipe.drop, list) and pipe.paths is not None:
+                alter_delete = self.name("alter_delete", owner.alter_delete)
+                for key in pipe.drop:
+                    if key in pipe.paths or \
+                            _is_default(owner.alter_delete, Pipe):
+                        self.emit(1, self.delete(key))
+                    else:
+                        self.emit(1, "obj = %s(obj, %s)" % (
+                            alter_delete, self.constant([key])))
+            elif isinstance(pipe.drop, list) and \
+                    _is_default(owner.alter_delete, Pipe):
+                for key in pipe.drop:
+                    self.emit(1, self.delete(key))
+            else:
+                self.emit(1, "obj = %s(obj, %s)" % (
+                    self.name("alter_delete", owner.alter_delete),
+                    self.constant(pipe.drop)))
+            self.emit(1, "if not obj:")
+            self.emit(2, "return obj")
+        for operator, method, key, alter_value, alter_info in pipe.alters:
+            alter_value = self.constant(alter_value)
+            name = getattr(_function(method), "__name__", None)
+            if name in alter_templates and _is_default(method, Alter):
+                self.emit(1, self.set(key, alter_templates[name] % {
+                    "value": self.get(key, self.path(key)),
+                    "alter": alter_value}))
+                continue
+            self.emit(1, "value = %s" % self.get(key, self.path(key)))
+            if operator in owner.mutating_operators:
+                self.emit(1, "if copy_on_write and isinstance(value, list):")
+                self.emit(2, "value = list(value)")
+            self.emit(1, self.set(key, "%s(value, %s, %s)" % (
+                self.name("alter", method), alter_value,
+                self.constant(alter_info))))
+        if pipe.altered_keys:
+            self.emit(1, "if memo:")
+            self.emit(2, "forget(memo, %s)" % self.constant(pipe.altered_keys))
+        self.emit(1, "return obj")
+
+    def apply(self):
+        self.emit(0, "def apply(obj, memo=None, copy_on_write=False):")
+        if not self.pipe.keys:
+            self.emit(1, "return obj")
+            return
+        self.emit(1, "if not match(obj, memo):")
+        self.emit(2, "return obj")
+        self.emit(1, "return alter(obj, memo, copy_on_write)")
+
+    def generate(self):
+        """
+        Return source of functions.
+        """
+        self.match()
+        self.emit(0, "")
+        self.alter()
+        self.emit(0, "")
+        self.apply()
+        return "\n".join(self.lines) + "\n"
+
+
+class SourceLoader(object):
+    """
+    Loader giving generated source to linecache lazily.
+    """
+    __slots__ = ("source",)
+
+    def __init__(self, source):
+        self.source = source
+
+    def get_source(self, name):
+        return self.source
+
+
+class GeneratedPipe(CompiledPipe):
+    """
+    CompiledPipe which match, alter and apply are Python functions
+    generated for this pipe: comparisons are inlined, condition values are
+    literals and keys(attributes) are accessed directly. Compiled code is
+    cached by hash of pipe specification in code_cache of Pipe.
+
+    Generated source is kept in source attribute and shown in tracebacks.
+    """
+    __slots__ = ("source", "match", "alter", "apply")
+
+    def __init__(self, owner, spec, priority, mode, keys, drop, alters):
+        CompiledPipe.__init__(
+            self, owner, spec, priority, mode, keys, drop, alters)
+        self.generate()
+
+    def generate(self):
+        generator = Generator(self)
+        source = generator.generate()
+        cache = getattr(self.owner, "code_cache", None)
+        key = spec_hash(self.spec)
+        code = None
+        if cache is not None:
+            cached = cache.get(key, None)
+            if cached is not None and cached[0] == source:
+                code = cached[1]
+        filename = "fly-pipe-%s" % key[:12]
+        if code is None:
+            code = compile(source, filename, "exec")
+            if cache is not None:
+                cache.set(key, (source, code))
+        namespace = generator.namespace
+        # tracebacks get generated lines from loader - nothing is added to
+        # linecache until they are shown.
+        namespace["__name__"] = filename
+        namespace["__loader__"] = SourceLoader(source)
+        exec(code, namespace)
+        self.source = source
+        self.match = namespace["match"]
+        self.alter = namespace["alter"]
+        self.apply = namespace["apply"]
+
+    def __getstate__(self):
+        # generated functions can not be pickled - they are generated again.
+        state = CompiledPipe.__getstate__(self)
+        for name in ("match", "alter", "apply"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        CompiledPipe.__setstate__(self, state)
+        self.generate()
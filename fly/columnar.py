@@ -0,0 +1,394 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from operator import eq, ne, gt, lt, ge, le
+from .pipes import Logic, string_types, _missing
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# comparison operators NumPy evaluates for whole arrays.
+_comparisons = {
+    "exact": eq,
+    "ne": ne,
+    "gt": gt,
+    "lt": lt,
+    "gte": ge,
+    "lte": le
+}
+
+# types of values NumPy keeps in arrays of native dtype.
+_native_types = (bool, int, float, str)
+
+
+def to_columns(objects, keys=None):
+    """
+    Return dictionary key -> list of values of this key in objects.
+    Missing keys get None.
+    """
+    objects = list(objects)
+    if keys is None:
+        keys = []
+        for obj in objects:
+            for key in obj:
+                if key not in keys:
+                    keys.append(key)
+    return dict((key, [obj.get(key, None) for obj in objects]) for key in keys)
+
+
+def to_records(columns, kept=None):
+    """
+    Return list of dictionaries from columns, None for rows which are not
+    kept.
+    """
+    columns = dict(
+        (key, column.tolist() if hasattr(column, "tolist") else column)
+        for key, column in columns.items())
+    size = len(next(iter(columns.values()))) if columns else 0
+    records = []
+    for row in range(size):
+        if kept is not None and not kept[row]:
+            records.append(None)
+        else:
+            records.append(
+                dict((key, column[row]) for key, column in columns.items()))
+    return records
+
+
+class ColumnarPipe(object):
+    """
+    Apply compiled pipes of Pipe to batch of records held column-wise:
+    dictionary key -> array (NumPy array or list) of values of this key.
+
+    Every pipe is evaluated for all rows at once: conditions give masks of
+    rows, which are combined according to mode of key and mode of pipe,
+    then alters are applied to selected rows in bulk. Rows are processed
+    with the same semantics as Pipe.process processes objects - later
+    conditions are not evaluated for rows already decided. Comparisons
+    and string operators are vectorized when NumPy is available and
+    column has native dtype, other operators are called per value. Every
+    distinct value of batch is converted only once per value type.
+
+    Batch passed in is not modified. Dropped keys become None.
+    """
+    def __init__(self, pipe, use_numpy=True):
+        self.pipe = pipe
+        self.numpy = numpy if use_numpy else None
+
+    def column(self, values):
+        """
+        Return values as column of this backend.
+        """
+        np = self.numpy
+        if np is None:
+            return list(values)
+        if isinstance(values, np.ndarray):
+            return values
+        values = list(values)
+        types = set(type(value) for value in values)
+        if len(types) == 1 and types.pop() in _native_types:
+            return np.array(values)
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+    def rows(self, size):
+        if self.numpy is None:
+            return list(range(size))
+        return self.numpy.arange(size)
+
+    def take(self, column, rows):
+        if self.numpy is None:
+            return [column[row] for row in rows]
+        return column[rows]
+
+    def compress(self, values, mask):
+        if self.numpy is None:
+            return [value for value, ok in zip(values, mask) if ok]
+        return values[mask]
+
+    def invert(self, mask):
+        if self.numpy is None:
+            return [not ok for ok in mask]
+        return ~mask
+
+    def union(self, parts):
+        """
+        Return sorted union of disjoint row sets.
+        """
+        if self.numpy is None:
+            return sorted(row for part in parts for row in part)
+        if not parts:
+            return self.numpy.arange(0)
+        return self.numpy.sort(self.numpy.concatenate(parts))
+
+    def difference(self, rows, removed):
+        if self.numpy is None:
+            removed = set(removed)
+            return [row for row in rows if row not in removed]
+        return self.numpy.setdiff1d(rows, removed, assume_unique=True)
+
+    def convert(self, key, values, conversions):
+        """
+        Convert values of key - every distinct value once per batch.
+        """
+        cache = conversions.setdefault(
+            (key.value_type, key.value_format), {})
+        converted = []
+        for value in values:
+            try:
+                result = cache.get((value, type(value)), _missing)
+            except TypeError:
+                # unhashable value.
+                converted.append(key.convert(value))
+                continue
+            if result is _missing:
+                result = cache[(value, type(value))] = key.convert(value)
+            converted.append(result)
+        return self.column(converted)
+
+    def lower(self, values):
+        # str.lower may change length of string, so not numpy.char.lower.
+        return self.column([value.lower() for value in values])
+
+    def vectorized(self, operator, values, condition_value):
+        """
+        Return mask of operator applied to NumPy array or None if operator
+        can not be vectorized for these values.
+        """
+        np = self.numpy
+        kind = values.dtype.kind
+        if operator in ("in", "not_in") and \
+                isinstance(condition_value, frozenset):
+            members = list(condition_value)
+            if kind == "U":
+                vectorized = all(
+                    isinstance(member, string_types) for member in members)
+            elif kind in "iuf":
+                vectorized = all(
+                    isinstance(member, (int, float)) and
+                    not isinstance(member, bool) for member in members)
+            else:
+                vectorized = False
+            if not vectorized:
+                return None
+            mask = np.isin(values, members)
+            return mask if operator == "in" else ~mask
+        if kind == "U" and isinstance(condition_value, string_types):
+            if operator in _comparisons:
+                return _comparisons[operator](values, condition_value)
+            if operator == "startswith":
+                return np.char.startswith(values, condition_value)
+            if operator == "endswith":
+                return np.char.endswith(values, condition_value)
+            if operator == "contains":
+                return np.char.find(values, condition_value) > -1
+        elif kind in "biuf" and operator in _comparisons and \
+                isinstance(condition_value, (int, float)):
+            return _comparisons[operator](values, condition_value)
+        return None
+
+    def evaluate(self, condition, values):
+        """
+        Return mask of rows which values satisfy condition.
+        """
+        operator, method, condition_value, lower, _found_key = condition
+        np = self.numpy
+        if np is not None:
+            if lower:
+                operator = self.pipe.lowered_operators.get(operator, operator)
+            mask = self.vectorized(operator, values, condition_value)
+            if mask is not None:
+                return mask
+            return np.fromiter(
+                (bool(method(value, condition_value)) for value in values),
+                dtype=bool, count=len(values))
+        return [bool(method(value, condition_value)) for value in values]
+
+    def select_key(self, key, columns, rows, conversions):
+        """
+        Return rows which values of key satisfy its conditions.
+        """
+        column = columns.get(key.key)
+        if column is None:
+            values = self.column([None] * len(rows))
+        else:
+            values = self.take(column, rows)
+        if key.convert is not None:
+            values = self.convert(key, values, conversions)
+        is_or = key.mode == Logic.OR
+        matched = []
+        lowered = None
+        for condition in key.conditions:
+            if not len(rows):
+                break
+            if condition[3]:
+                if lowered is None:
+                    lowered = self.lower(values)
+                mask = self.evaluate(condition, lowered)
+            else:
+                mask = self.evaluate(condition, values)
+            if is_or:
+                matched.append(self.compress(rows, mask))
+                mask = self.invert(mask)
+            rows = self.compress(rows, mask)
+            values = self.compress(values, mask)
+            if lowered is not None:
+                lowered = self.compress(lowered, mask)
+        if is_or:
+            return self.union(matched)
+        return rows
+
+    def select(self, pipe, columns, rows, conversions):
+        """
+        Return rows which match conditions of compiled pipe.
+        """
+        if pipe.mode == Logic.OR:
+            matched = []
+            for key in pipe.keys:
+                if not len(rows):
+                    break
+                selected = self.select_key(key, columns, rows, conversions)
+                matched.append(selected)
+                rows = self.difference(rows, selected)
+            return self.union(matched)
+        for key in pipe.keys:
+            if not len(rows):
+                break
+            rows = self.select_key(key, columns, rows, conversions)
+        return rows
+
+    def writable(self, key, columns, written, size):
+        """
+        Return column of key which can be modified - a copy of column
+        passed in.
+        """
+        if key not in written:
+            column = columns.get(key)
+            if column is None:
+                column = self.column([None] * size)
+            elif self.numpy is None:
+                column = list(column)
+            else:
+                column = column.copy()
+            columns[key] = column
+            written.add(key)
+        return columns[key]
+
+    def assign(self, key, columns, written, size, rows, values):
+        """
+        Set values of key in rows.
+        """
+        column = self.writable(key, columns, written, size)
+        np = self.numpy
+        if np is None:
+            for row, value in zip(rows, values):
+                column[row] = value
+            return
+        values = self.column(values)
+        if values.dtype != column.dtype:
+            if values.dtype.kind == "U" and column.dtype.kind == "U":
+                dtype = values.dtype
+                if column.dtype.itemsize > dtype.itemsize:
+                    dtype = column.dtype
+            else:
+                # mixed types keep Python values as they are.
+                dtype = object
+            if column.dtype != dtype:
+                column = columns[key] = column.astype(dtype)
+        column[rows] = values
+
+    def alter_values(self, alter, values):
+        """
+        Return values changed by alter operator.
+        """
+        operator, method, _key, alter_value, alter_info = alter
+        np = self.numpy
+        count = len(values)
+        if operator == "set":
+            return [alter_value] * count
+        if np is not None:
+            kind = values.dtype.kind
+            if operator == "incr" and kind in "iuf" and \
+                    isinstance(alter_value, (int, float)) and \
+                    not isinstance(alter_value, bool):
+                return values + alter_value
+            if operator == "replace" and kind == "U" and \
+                    isinstance(alter_value, string_types):
+                replacement = self.pipe.convert_cached(
+                    alter_info.get('replacement', ''),
+                    alter_info.get("type", None),
+                    alter_info.get("format", None)
+                )
+                if isinstance(replacement, string_types):
+                    return np.char.replace(values, alter_value, replacement)
+        if operator in self.pipe.mutating_operators:
+            # lists of batch are not modified.
+            values = [list(value) if isinstance(value, list) else value
+                      for value in values]
+        return [method(value, alter_value, alter_info) for value in values]
+
+    def alter(self, pipe, columns, written, size, rows):
+        """
+        Apply alter section of compiled pipe to rows.
+        """
+        if isinstance(pipe.drop, list):
+            for key in pipe.drop:
+                self.assign(key, columns, written, size, rows,
+                            [None] * len(rows))
+        for alter in pipe.alters:
+            key = alter[2]
+            column = columns.get(key)
+            if column is None:
+                values = self.column([None] * len(rows))
+            else:
+                values = self.take(column, rows)
+            self.assign(key, columns, written, size, rows,
+                        self.alter_values(alter, values))
+
+    def process(self, columns):
+        """
+        Pull batch through pipes. Return tuple of (columns, kept) where
+        kept is mask of rows which were not dropped.
+        """
+        columns = dict(
+            (key, self.column(values)) for key, values in columns.items())
+        sizes = set(len(column) for column in columns.values())
+        if len(sizes) > 1:
+            raise ValueError('columns must have equal length')
+        size = sizes.pop() if sizes else 0
+        alive = self.rows(size)
+        written = set()
+        conversions = {}
+        for pipe in self.pipe.pipes:
+            if not pipe.keys or not len(alive):
+                continue
+            rows = self.select(pipe, columns, alive, conversions)
+            if not len(rows):
+                continue
+            if pipe.drop and not isinstance(pipe.drop, list):
+                alive = self.difference(alive, rows)
+                continue
+            self.alter(pipe, columns, written, size, rows)
+        if self.numpy is None:
+            kept = [False] * size
+            for row in alive:
+                kept[row] = True
+        else:
+            kept = self.numpy.zeros(size, dtype=bool)
+            kept[alive] = True
+        return columns, kept
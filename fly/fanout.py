@@ -0,0 +1,99 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from weakref import WeakValueDictionary
+from .pipes import CompiledPipe, spec_hash, _priority_of
+
+
+class FanOut(object):
+    """
+    Apply pipe sets of many subscribers to one message - for example to
+    broadcast chat message to users with their own rules.
+
+    Message is never modified. Values derived from message (lowercased
+    values, conversions) are computed once for all subscribers, every
+    distinct pipe is matched once per state of message and every distinct
+    sequence of alterations is applied once - subscribers with identical
+    outcome get the same result object, so treat results as read-only.
+    """
+    def __init__(self, pipe, subscribers=None):
+        # Pipe (or ObjectPipe) which compiles pipes of subscribers.
+        self.pipe = pipe
+        # subscriber -> list of compiled pipes sorted by priority.
+        self.subscribers = {}
+        # pipes with equal specifications are compiled once and shared.
+        self.compiled = WeakValueDictionary()
+        if subscribers:
+            for subscriber, pipes in subscribers.items():
+                self.subscribe(subscriber, pipes)
+
+    def compile(self, pipe):
+        if isinstance(pipe, CompiledPipe):
+            return pipe
+        pipe = self.pipe.load_pipe(pipe)
+        key = spec_hash(pipe)
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            compiled = self.compiled[key] = self.pipe.compile(pipe)
+        return compiled
+
+    def subscribe(self, subscriber, pipes):
+        """
+        Set pipes of subscriber - list of pipe specifications (or compiled
+        pipes) or Pipe instance.
+        """
+        if hasattr(pipes, "pipes"):
+            pipes = pipes.pipes
+        compiled = [self.compile(pipe) for pipe in pipes]
+        compiled.sort(key=_priority_of)
+        self.subscribers[subscriber] = compiled
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.pop(subscriber, None)
+
+    def process(self, message):
+        """
+        Return dictionary subscriber -> message processed by pipes of this
+        subscriber (None if message was dropped).
+        """
+        if message is None:
+            return dict((subscriber, None) for subscriber in self.subscribers)
+        # sequence of matched pipes -> (object, memo) after their alterations.
+        states = {(): (message, {})}
+        # (sequence of matched pipes, pipe) -> result of matching.
+        matches = {}
+        results = {}
+        for subscriber, pipes in self.subscribers.items():
+            path = ()
+            obj, memo = message, states[path][1]
+            for pipe in pipes:
+                if pipe.keys:
+                    match_key = (path, pipe)
+                    is_matched = matches.get(match_key)
+                    if is_matched is None:
+                        is_matched = matches[match_key] = pipe.match(obj, memo)
+                    if is_matched:
+                        path = path + (pipe,)
+                        state = states.get(path)
+                        if state is None:
+                            memo = dict(memo)
+                            state = states[path] = (
+                                pipe.alter(obj, memo, copy_on_write=True), memo)
+                        obj, memo = state
+                if not obj:
+                    obj = None
+                    break
+            results[subscriber] = obj
+        return results
@@ -0,0 +1,599 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from collections import deque
+from .pipes import Logic, Match, string_types, memo_key, _missing, _is_default
+
+
+# key of node in PrefixTrie which keeps values of prefix.
+_VALUES = None
+
+
+class PrefixTrie(object):
+    """
+    Trie of string prefixes. Finds values of all prefixes of a string in
+    one pass over this string.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(_VALUES, []).append(value)
+
+    def find(self, string):
+        """
+        Return list of values of all prefixes of string.
+        """
+        node = self.root
+        found = list(node.get(_VALUES, ()))
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            values = node.get(_VALUES)
+            if values:
+                found.extend(values)
+        return found
+
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton: finds all patterns contained in a string in
+    one pass over this string however many patterns there are.
+
+    Once patterns are added find can be called from many threads.
+    """
+    def __init__(self):
+        self.patterns = set()
+        # goto transitions and patterns ending in node.
+        self.goto = [{}]
+        self.terminal = [()]
+        # (failure links, all patterns found when node reached) or None
+        # if they must be computed again. Replaced at once, so readers
+        # never see links and patterns of different builds.
+        self.tables = ([0], [()])
+
+    def add(self, pattern):
+        if pattern in self.patterns:
+            return
+        self.patterns.add(pattern)
+        goto, terminal = self.goto, self.terminal
+        node = 0
+        for char in pattern:
+            child = goto[node].get(char)
+            if child is None:
+                child = len(goto)
+                goto[node][char] = child
+                goto.append({})
+                terminal.append(())
+            node = child
+        terminal[node] = terminal[node] + (pattern,)
+        # failure links must be computed again.
+        self.tables = None
+
+    def build(self):
+        goto = self.goto
+        output = list(self.terminal)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail_to = goto[state].get(char, 0)
+                fail[child] = fail_to if fail_to != child else 0
+                output[child] = self.terminal[child] + output[fail[child]]
+        self.tables = (fail, output)
+        return self.tables
+
+    def find(self, string):
+        """
+        Return set of patterns contained in string.
+        """
+        tables = self.tables
+        if tables is None:
+            tables = self.build()
+        fail, output = tables
+        goto = self.goto
+        found = set(output[0])
+        node = 0
+        for char in string:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+def lowered(value, memo, lower_key):
+    """
+    Return lowercased value computed once per memo.
+    """
+    result = memo.get(lower_key)
+    if result is None:
+        result = memo[lower_key] = value.lower()
+    return result
+
+
+class Group(object):
+    """
+    Base class of groups of pipes of PipeIndex by required values of one
+    key(attribute).
+    """
+    def __init__(self, key, convert, value_type, value_format, path=None):
+        self.key = key
+        self.convert = convert
+        self.value_type = value_type
+        self.value_format = value_format
+        # KeyPath of nested key or None.
+        self.path = path
+        # top level key of key(attribute).
+        self.root = key if path is None else path.root
+        self.value_key = memo_key(key, path, "value", value_type, value_format)
+        self.members = []
+        # pipe -> values it was added with.
+        self.values = {}
+
+    def add(self, pipe, values):
+        self.members.append(pipe)
+        self.values[pipe] = values
+        for value in values:
+            self.add_value(pipe, value)
+
+    def add_value(self, pipe, value):
+        raise NotImplementedError
+
+    def copy(self, removed=()):
+        """
+        Return the same group without removed pipes. Group itself is not
+        changed, so it can be used meanwhile.
+        """
+        group = self.__class__(self.key, self.convert, self.value_type,
+                               self.value_format, self.path)
+        for pipe in self.members:
+            if pipe not in removed:
+                group.add(pipe, self.values[pipe])
+        return group
+
+
+class ExactGroup(Group):
+    """
+    Pipes which require exact value of key(attribute) hashed into buckets
+    by this value.
+    """
+    def __init__(self, key, convert, value_type, value_format, path=None):
+        Group.__init__(self, key, convert, value_type, value_format, path)
+        self.buckets = {}
+        # values of buckets not shared with other copies of group.
+        self.owned = set()
+
+    def add_value(self, pipe, value):
+        if value not in self.owned:
+            self.buckets[value] = list(self.buckets.get(value, ()))
+            self.owned.add(value)
+        self.buckets[value].append(pipe)
+
+    def copy(self, removed=()):
+        # buckets without removed pipes are shared.
+        group = self.__class__(self.key, self.convert, self.value_type,
+                               self.value_format, self.path)
+        group.members = list(self.members)
+        group.values = dict(self.values)
+        group.buckets = dict(self.buckets)
+        for pipe in removed:
+            values = group.values.pop(pipe, None)
+            if values is None:
+                continue
+            group.members.remove(pipe)
+            for value in values:
+                bucket = [other for other in group.buckets.get(value, ())
+                          if other is not pipe]
+                if bucket:
+                    group.buckets[value] = bucket
+                    group.owned.add(value)
+                else:
+                    group.buckets.pop(value, None)
+        return group
+
+    def find(self, value, memo):
+        try:
+            return self.buckets.get(value, ())
+        except TypeError:
+            # unhashable value - let pipes decide themselves.
+            return self.members
+
+
+class IExactGroup(ExactGroup):
+    """
+    The same as ExactGroup for iexact conditions - buckets are looked up by
+    lowercased value shared with other case insensitive conditions.
+    """
+    def __init__(self, key, convert, value_type, value_format, path=None):
+        ExactGroup.__init__(
+            self, key, convert, value_type, value_format, path)
+        self.lower_key = memo_key(key, path, "lower", value_type, value_format)
+
+    def find(self, value, memo):
+        if not isinstance(value, string_types):
+            return self.members
+        return self.buckets.get(lowered(value, memo, self.lower_key), ())
+
+
+class PrefixGroup(Group):
+    """
+    Pipes which require string value of key(attribute) to start with one
+    of prefixes grouped into PrefixTrie.
+    """
+    def __init__(self, key, convert, value_type, value_format, path=None):
+        Group.__init__(self, key, convert, value_type, value_format, path)
+        self.trie = PrefixTrie()
+
+    def add_value(self, pipe, value):
+        self.trie.add(value, pipe)
+
+    def find(self, value, memo):
+        if not isinstance(value, string_types):
+            return self.members
+        return self.trie.find(value)
+
+
+class ContainsGroup(Group):
+    """
+    Pipes which require string value of key(attribute) to contain one of
+    substrings. All substrings are found with one Automaton pass and kept
+    in memo, so contains conditions of all pipes are checked without
+    scanning value again.
+    """
+    ignore_case = False
+
+    def __init__(self, key, convert, value_type, value_format, path=None):
+        Group.__init__(self, key, convert, value_type, value_format, path)
+        self.automaton = Automaton()
+        self.pipes = {}
+        self.lower_key = memo_key(key, path, "lower", value_type, value_format)
+        self.found_key = memo_key(
+            key, path, "found", self.ignore_case, value_type, value_format)
+
+    def add_value(self, pipe, value):
+        self.automaton.add(value)
+        self.pipes.setdefault(value, []).append(pipe)
+
+    def find(self, value, memo):
+        if not isinstance(value, string_types):
+            return self.members
+        if self.ignore_case:
+            value = lowered(value, memo, self.lower_key)
+        found = self.automaton.find(value)
+        memo[self.found_key] = (self.automaton.patterns, found)
+        pipes = []
+        for pattern in found:
+            pipes.extend(self.pipes[pattern])
+        return pipes
+
+
+class IContainsGroup(ContainsGroup):
+    """
+    The same as ContainsGroup for icontains conditions - lowercased value
+    is shared with other case insensitive conditions through memo.
+    """
+    ignore_case = True
+
+
+class PipeIndex(object):
+    """
+    Index over match sections of compiled pipes. Every pipe which can
+    match only when some key(attribute) has exact (or iexact) value,
+    starts with some prefix or contains some substring is put into hash
+    bucket, prefix trie or substring automaton of this key, so for object
+    we evaluate only pipes which can possibly match it. Other pipes are
+    evaluated for every object.
+    """
+    # group classes from the most selective to the least one.
+    group_classes = (
+        ExactGroup, IExactGroup, PrefixGroup, ContainsGroup, IContainsGroup)
+
+    # operators groups check themselves instead of make_match_* methods.
+    indexed_operators = (
+        "exact", "in", "iexact", "startswith", "contains", "icontains")
+
+    def __init__(self, owner, pipes):
+        self.get_object_value = owner.get_object_value
+        # operators with overriden methods are checked by pipes only.
+        self.operators = frozenset(
+            operator for operator in self.indexed_operators
+            if _is_default(getattr(owner, "make_match_%s" % operator), Match))
+        # pipe -> (priority, sequence number) to restore order of candidates.
+        self.order = {}
+        # (kind, key, value_type, value_format) -> ExactGroup or PrefixGroup.
+        self.groups = {}
+        # pipes which can't be indexed.
+        self.unindexed = []
+        # top level keys(attributes) of all groups.
+        self.indexed_keys = set()
+        # pipes that change indexed keys so candidates must be found again.
+        self.reindex = set()
+        # pipe -> ids of groups it is added to.
+        self.placement = {}
+        # ids of groups shared with other index which must be copied
+        # before change.
+        self.shared = set()
+        for sequence, pipe in enumerate(pipes):
+            self.add(pipe, sequence)
+
+    def add(self, pipe, sequence):
+        self.order[pipe] = (pipe.priority, sequence)
+        if not pipe.keys:
+            # pipe without match section never changes object.
+            return
+        found = self.required_values(pipe)
+        if found is None:
+            self.unindexed.append(pipe)
+        else:
+            compiled_key, required = found
+            values = {}
+            for group_class, value in required:
+                values.setdefault(group_class, []).append(value)
+            group_ids = self.placement[pipe] = []
+            for group_class, group_values in values.items():
+                group_id, group = self.group(group_class, compiled_key)
+                group.add(pipe, group_values)
+                group_ids.append(group_id)
+        if pipe.altered_keys & self.indexed_keys:
+            self.reindex.add(pipe)
+
+    def update(self, added=(), removed=()):
+        """
+        Return new index with removed pipes excluded and added pipes - list
+        of (pipe, sequence) pairs - included. Only groups of these pipes
+        are changed (copied), other groups are shared with this index, which
+        stays untouched and can be used meanwhile.
+        """
+        removed = set(removed)
+        index = self.__class__.__new__(self.__class__)
+        index.get_object_value = self.get_object_value
+        index.operators = self.operators
+        index.order = dict(self.order)
+        index.groups = dict(self.groups)
+        index.unindexed = [
+            pipe for pipe in self.unindexed if pipe not in removed]
+        index.indexed_keys = set(self.indexed_keys)
+        index.reindex = self.reindex - removed
+        index.placement = dict(self.placement)
+        index.shared = set(self.groups)
+        affected = set()
+        for pipe in removed:
+            index.order.pop(pipe, None)
+            affected.update(index.placement.pop(pipe, ()))
+        for group_id in affected:
+            group = index.groups[group_id].copy(removed)
+            index.shared.discard(group_id)
+            if group.members:
+                index.groups[group_id] = group
+            else:
+                del index.groups[group_id]
+        for pipe, sequence in added:
+            index.add(pipe, sequence)
+        index.shared = set()
+        return index
+
+    def group(self, group_class, compiled_key):
+        """
+        Return (group_id, group) of compiled key creating group if needed.
+        """
+        group_id = (
+            group_class,
+            compiled_key.key,
+            compiled_key.value_type,
+            compiled_key.value_format
+        )
+        group = self.groups.get(group_id)
+        if group_id in self.shared:
+            group = self.groups[group_id] = group.copy()
+            self.shared.discard(group_id)
+        if group is None:
+            group = group_class(
+                compiled_key.key,
+                compiled_key.convert,
+                compiled_key.value_type,
+                compiled_key.value_format,
+                compiled_key.path
+            )
+            self.groups[group_id] = group
+            if group.root not in self.indexed_keys:
+                self.indexed_keys.add(group.root)
+                for pipe in self.order:
+                    if group.root in pipe.altered_keys:
+                        self.reindex.add(pipe)
+        return group_id, group
+
+    def required_values(self, pipe):
+        """
+        Return (compiled_key, required) where required is a list of
+        (group_class, value) pairs - pipe can match object only if its key
+        satisfies one of them. Return None if there is no such key.
+        """
+        if pipe.mode == Logic.OR and len(pipe.keys) > 1:
+            return None
+        best, best_rank = None, None
+        for compiled_key in pipe.keys:
+            required = self.key_required_values(compiled_key)
+            if required is None:
+                continue
+            rank = max([self.rank(group_class) for group_class, _ in required] or [0])
+            if best is None or rank < best_rank:
+                best, best_rank = (compiled_key, required), rank
+        return best
+
+    def key_required_values(self, compiled_key):
+        conditions = compiled_key.conditions
+        if compiled_key.mode == Logic.OR and len(conditions) > 1:
+            # all conditions must be indexable.
+            required = []
+            for condition in conditions:
+                group_class = self.group_class(compiled_key, condition)
+                if group_class is None:
+                    return None
+                required.extend(
+                    (group_class, value) for value in self.values(condition))
+            return required
+        best, best_rank = None, None
+        for condition in conditions:
+            group_class = self.group_class(compiled_key, condition)
+            if group_class is None:
+                continue
+            values = self.values(condition)
+            rank = (self.rank(group_class), len(values))
+            if best is None or rank < best_rank:
+                best, best_rank = (group_class, values), rank
+        if best is None:
+            return None
+        group_class, values = best
+        return [(group_class, value) for value in values]
+
+    def values(self, condition):
+        """
+        Return list of values one of which condition requires.
+        """
+        if condition[0] == "in":
+            return list(condition[2])
+        return [condition[2]]
+
+    def rank(self, group_class):
+        """
+        The more selective group is the less its rank.
+        """
+        return self.group_classes.index(group_class)
+
+    def group_class(self, compiled_key, condition):
+        """
+        Return group class which can index condition or None.
+        """
+        operator, condition_value = condition[0], condition[2]
+        if operator not in self.operators:
+            return None
+        if operator == "exact":
+            try:
+                hash(condition_value)
+            except TypeError:
+                return None
+            return ExactGroup
+        if operator == "in" and isinstance(condition_value, frozenset):
+            # any value of set - pipe is put into bucket of every value.
+            return ExactGroup
+        if not isinstance(condition_value, string_types):
+            return None
+        if compiled_key.value_type not in (None, "str"):
+            return None
+        if operator in ("iexact", "icontains") and not condition[3]:
+            # condition value is not lowercased - operator is overriden.
+            return None
+        if operator == "iexact":
+            # condition value is already lowercased.
+            return IExactGroup
+        if operator == "startswith":
+            return PrefixGroup
+        if operator == "contains":
+            return ContainsGroup
+        if operator == "icontains":
+            return IContainsGroup
+        return None
+
+    def candidates(self, obj, memo=None):
+        """
+        Return pipes which can match object in order of priority.
+        """
+        if memo is None:
+            memo = {}
+        found = set(self.unindexed)
+        get_object_value = self.get_object_value
+        for group in self.groups.values():
+            if group.convert is not None:
+                # converted value is shared with pipes through memo.
+                value = memo.get(group.value_key, _missing)
+                if value is _missing:
+                    try:
+                        if group.path is not None:
+                            value = group.path.get(obj)
+                        else:
+                            value = get_object_value(obj, group.key)
+                        value = group.convert(value)
+                    except Exception:
+                        # conversion error will be raised by pipes themselves.
+                        found.update(group.members)
+                        continue
+                    memo[group.value_key] = value
+            elif group.path is not None:
+                value = group.path.get(obj)
+            else:
+                value = get_object_value(obj, group.key)
+            found.update(group.find(value, memo))
+        return sorted(found, key=self.order.__getitem__)
+
+    def process(self, obj, memo=None, copy_on_write=False, trace=None):
+        """
+        Pull object through candidate pipes and return it.
+        """
+        if memo is None:
+            memo = {}
+        if not obj:
+            # empty object is dropped by the first pipe which leaves it
+            # empty (as Pipe.process does) - so all pipes are applied.
+            for pipe in sorted(self.order, key=self.order.__getitem__):
+                if pipe.keys and pipe.match(obj, memo):
+                    if trace is not None:
+                        trace.append(pipe)
+                    obj = pipe.alter(obj, memo, copy_on_write)
+                if not obj:
+                    return None
+            return obj
+        return self.pull(obj, memo, self.candidates(obj, memo), copy_on_write,
+                         trace=trace)
+
+    def pull(self, obj, memo, candidates, copy_on_write=False, matched=False,
+             trace=None):
+        """
+        Pull object through candidate pipes. Set matched to True if the
+        first candidate is already known to match object. Matched pipes
+        are appended to trace list if it is given.
+        """
+        position = 0
+        while position < len(candidates):
+            pipe = candidates[position]
+            position += 1
+            if matched:
+                matched = False
+            elif not pipe.match(obj, memo):
+                continue
+            if trace is not None:
+                trace.append(pipe)
+            obj = pipe.alter(obj, memo, copy_on_write)
+            if not obj:
+                return None
+            if pipe in self.reindex:
+                # indexed key changed - candidates of remaining pipes too.
+                order = self.order[pipe]
+                candidates = [
+                    candidate for candidate in self.candidates(obj, memo)
+                    if self.order[candidate] > order
+                ]
+                position = 0
+        return obj
@@ -0,0 +1,96 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from itertools import islice
+from multiprocessing import Pool
+
+
+# Pipe instance of worker process, set once by _init_worker.
+_worker_pipe = None
+
+
+def _init_worker(pipe):
+    global _worker_pipe
+    _worker_pipe = pipe
+
+
+def _process_chunk(args):
+    chunk, skip_none = args
+    return list(_worker_pipe.process_many(chunk, skip_none=skip_none))
+
+
+def chunked(objects, chunksize):
+    """
+    Split iterable into lists of chunksize objects lazily.
+    """
+    iterator = iter(objects)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ParallelPipe(object):
+    """
+    Run Pipe (or ObjectPipe) over large batches of objects in a pool of
+    worker processes. Pipe with its compiled pipes (and index) is sent to
+    every worker once, then objects are sent in chunks of chunksize.
+
+    Objects are processed in workers, so results are copies - objects
+    from iterable are not modified. Both objects and pipe must be
+    picklable.
+    """
+    def __init__(self, pipe, processes=None, chunksize=1000, ordered=True):
+        self.pipe = pipe
+        self.chunksize = chunksize
+        self.ordered = ordered
+        self.pool = Pool(processes, _init_worker, (pipe,))
+
+    def process_many(self, objects, chunksize=None, ordered=None, skip_none=False):
+        """
+        Generator which yields processed objects. If ordered is False
+        results of chunks are yielded as soon as chunk is processed, so
+        order of objects is not kept.
+        """
+        if chunksize is None:
+            chunksize = self.chunksize
+        if ordered is None:
+            ordered = self.ordered
+        tasks = ((chunk, skip_none) for chunk in chunked(objects, chunksize))
+        if ordered:
+            results = self.pool.imap(_process_chunk, tasks)
+        else:
+            results = self.pool.imap_unordered(_process_chunk, tasks)
+        for chunk in results:
+            for obj in chunk:
+                yield obj
+
+    def close(self):
+        """
+        Stop worker processes.
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
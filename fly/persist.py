@@ -0,0 +1,116 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import gc
+import os
+import pickle
+import tempfile
+from hashlib import sha1
+from .pipes import Pipe, spec_hash, string_types
+
+
+# first bytes of cache file. Change version when pickled classes change
+# incompatibly, so old cache files are rebuilt.
+MAGIC = b"fly-pipes-6\n"
+
+# length of content hash in cache file.
+_key_length = 40
+
+
+def content_hash(pipes, pipe_class=Pipe, options=None):
+    """
+    Return hash of pipe specifications, pipe class and its options. JSON
+    strings are hashed as they are - without parsing.
+    """
+    digest = sha1()
+    digest.update(("%s.%s\n" % (
+        pipe_class.__module__, pipe_class.__name__)).encode("utf-8"))
+    digest.update(spec_hash(options or {}).encode("utf-8"))
+    for pipe in pipes:
+        if isinstance(pipe, bytes):
+            digest.update(b"b" + sha1(pipe).hexdigest().encode("utf-8"))
+        elif isinstance(pipe, string_types):
+            digest.update(
+                b"s" + sha1(pipe.encode("utf-8")).hexdigest().encode("utf-8"))
+        else:
+            digest.update(b"d" + spec_hash(pipe).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def save(pipe, path, key):
+    """
+    Write Pipe (with compiled pipes and index) to file. File is replaced
+    atomically, so concurrent readers see old or new file.
+    """
+    data = pickle.dumps(pipe, pickle.HIGHEST_PROTOCOL)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix=".fly-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(key.encode("ascii"))
+            f.write(data)
+        if hasattr(os, "replace"):
+            os.replace(temporary, path)
+        else:
+            os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def load(path, key):
+    """
+    Read Pipe saved with given key in one read. Return None if there is no
+    file, it was saved for other key or can not be unpickled anymore.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    header = len(MAGIC)
+    if data[:header] != MAGIC or \
+            data[header:header + _key_length] != key.encode("ascii"):
+        return None
+    # unpickling creates lots of objects - garbage collector would scan
+    # them many times meanwhile.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(data[header + _key_length:])
+    except Exception:
+        # classes of pickled pipe were changed - cache is stale.
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def load_or_build(path, pipes, pipe_class=Pipe, **options):
+    """
+    Return Pipe of pipe_class built from pipes with options. Pipe is
+    loaded from cache file at path if it was saved for the same pipes
+    and options, otherwise it is built and saved to path.
+
+    Cache file is unpickled, so it must be written by trusted process only.
+    """
+    pipes = list(pipes)
+    key = content_hash(pipes, pipe_class, options)
+    pipe = load(path, key)
+    if pipe is None:
+        pipe = pipe_class(pipes, **options)
+        save(pipe, path, key)
+    return pipe
@@ -14,10 +14,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 from __future__ import print_function
-from heapq import heappush, heappop
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from copy import copy, deepcopy
 from datetime import datetime, time, date, timedelta
+from functools import partial
+from hashlib import sha1
+import keyword
 import re
 import sys
+import threading
+import weakref
+from .cache import LRUCache
+from .stats import Stats, TimedCall, timer
 try:
     import simplejson as json
 except ImportError:
@@ -39,6 +48,211 @@ def pyiteritems(d):
     return iter(getattr(d, _iteritems)())
 
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# marker for values missing in caches.
+_missing = object()
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
+
+
+def _unshared(value):
+    """
+    Return value as it is - values of one-off pipes are not interned.
+    """
+    return value
+
+# type of compiled regex patterns.
+_pattern_type = type(re.compile(''))
+
+
+def _priority_of(pipe):
+    return pipe.priority
+
+
+class _OrderKeys(object):
+    """
+    Sequence of (priority, sequence number) of sorted pipes for bisect.
+    """
+    def __init__(self, pipes, order):
+        self.pipes = pipes
+        self.order = order
+
+    def __len__(self):
+        return len(self.pipes)
+
+    def __getitem__(self, position):
+        return self.order[self.pipes[position]]
+
+
+def spec_hash(spec):
+    """
+    Return hash of pipe specification which does not depend on order of
+    dictionary keys.
+    """
+    dump = json.dumps(spec, sort_keys=True, default=repr)
+    return sha1(dump.encode("utf-8")).hexdigest()
+
+
+def forget(memo, keys):
+    """
+    Remove values derived from given keys(attributes) from memo.
+    """
+    if keys:
+        for memo_key in list(memo):
+            if memo_key[0] in keys:
+                del memo[memo_key]
+
+
+def memo_key(key, path, *details):
+    """
+    Return memo key of value derived from object key(attribute). Values of
+    key path are filed under its top level key, so forget drops all of
+    them when top level key is changed.
+    """
+    if path is None:
+        return (key,) + details
+    return (path.root,) + details + (key,)
+
+
+# name step of key path and index step like [0].
+_path_name = re.compile(r'[^.\[\]]+')
+_path_index = re.compile(r'\[(-?\d+)\]')
+
+# time in default format parsed without strptime.
+_time_string = re.compile(r'(\d\d):(\d\d):(\d\d)$')
+
+# the first day of Unix epoch.
+_epoch = datetime(1970, 1, 1)
+
+# types of epoch seconds values.
+try:
+    _number_types = (int, long, float)
+except NameError:
+    _number_types = (int, float)
+
+# identifiers which can be accessed as obj.name in generated code.
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse_key_path(key):
+    """
+    Split key path like "meta.tags[0].name" into tuple of steps
+    ("meta", "tags", 0, "name").
+    """
+    steps = []
+    position = 0
+    length = len(key)
+    while True:
+        match = _path_name.match(key, position)
+        if match is None:
+            raise ValueError('Invalid key path %s' % key)
+        steps.append(match.group())
+        position = match.end()
+        while position < length and key[position] == "[":
+            match = _path_index.match(key, position)
+            if match is None:
+                raise ValueError('Invalid key path %s' % key)
+            steps.append(int(match.group(1)))
+            position = match.end()
+        if position == length:
+            return tuple(steps)
+        if key[position] != ".":
+            raise ValueError('Invalid key path %s' % key)
+        position += 1
+
+
+def _step_value(container, step):
+    """
+    Return value of one step of key path or None if there is no such.
+    """
+    if isinstance(step, int) or isinstance(container, dict):
+        try:
+            return container[step]
+        except (LookupError, TypeError):
+            return None
+    return getattr(container, step, None)
+
+
+def _can_set(container, step):
+    """
+    Test if step of key path can be set in container: dictionary, list with
+    such index or object with attributes.
+    """
+    if isinstance(container, dict):
+        return True
+    if isinstance(step, int):
+        return isinstance(container, list) and \
+            -len(container) <= step < len(container)
+    return hasattr(container, "__dict__") or hasattr(container, "__slots__")
+
+
+def _set_step(container, step, value):
+    if isinstance(step, int) or isinstance(container, dict):
+        container[step] = value
+    else:
+        setattr(container, step, value)
+
+
+def _del_step(container, step):
+    if isinstance(container, dict):
+        container.pop(step, None)
+    elif isinstance(step, int):
+        try:
+            del container[step]
+        except (LookupError, TypeError):
+            pass
+    else:
+        try:
+            delattr(container, step)
+        except AttributeError:
+            pass
+
+
+def _convert_moment(convert, value):
+    """
+    Return epoch seconds as they are, convert other values.
+    """
+    if type(value) in _number_types:
+        return value
+    return convert(value)
+
+
+def _function(method):
+    """
+    Return function of method.
+    """
+    return getattr(method, "__func__", method)
+
+
+def _is_default(method, cls):
+    """
+    Test if bound method is not overriden - it is the method of cls.
+    """
+    function = _function(method)
+    name = getattr(function, "__name__", None)
+    return name is not None and \
+        function is _function(getattr(cls, name, None))
+
+
+class AlterInfo(dict):
+    """
+    Alter section of one key. Compiled pipes share equal alter infos
+    (operators only read them) while some pipe uses them.
+    """
+    __slots__ = ("__weakref__",)
+
+    def __reduce__(self):
+        return (AlterInfo, (dict(self),))
+
+
 class Logic(object):
 
     AND = 'and'
@@ -61,6 +275,29 @@ class Converter(object):
         "str": str
     }
 
+    # types which conversion results are immutable so can be cached
+    # and shared between objects.
+    cacheable_types = (
+        "bool", "int", "float", "str",
+        "datetime", "date", "time", "timedelta"
+    )
+
+    # LRUCache instance or None to disable caching.
+    conversion_cache = None
+
+    # relative cost of value conversion used to reorder keys.
+    conversion_cost = {
+        "bool": 1,
+        "int": 1,
+        "float": 1,
+        "str": 1,
+        "timedelta": 2,
+        "datetime": 10,
+        "date": 10,
+        "time": 10,
+        "json": 10
+    }
+
     def convert(self, value, value_type, value_format):
         """
         Convert value according to given value_type and value_format.
@@ -83,6 +320,11 @@ class Converter(object):
                 is_string = isinstance(value, basestring)
             except NameError:
                 is_string = isinstance(value, str)
+            if is_string and value_type == "time" and \
+                    value_format == "%H:%M:%S":
+                match = _time_string.match(value)
+                if match is not None:
+                    return time(*[int(part) for part in match.groups()])
             if is_string:
                 value = datetime.strptime(value, value_format)
             if value_type == "datetime":
@@ -97,9 +339,230 @@ class Converter(object):
             return json.loads(value)
         return value
 
+    def convert_cached(self, value, value_type, value_format):
+        """
+        The same as convert but remembers results in conversion_cache, so
+        repeated values (like condition values or low cardinality object
+        values) are parsed only once.
+        """
+        if not value_type:
+            return value
+        cache = self.conversion_cache
+        if cache is None or value_type not in self.cacheable_types:
+            return self.convert(value, value_type, value_format)
+        # type of value is a part of key because 1 == 1.0 == True.
+        cache_key = (value, type(value), value_type, value_format)
+        try:
+            result = cache.get(cache_key, _missing)
+        except TypeError:
+            # unhashable value.
+            return self.convert(value, value_type, value_format)
+        if result is _missing:
+            result = self.convert(value, value_type, value_format)
+            cache.set(cache_key, result)
+        return result
+
 
 class Match(object):
 
+    # relative cost of operators used to reorder conditions.
+    operator_cost = {
+        "exact": 1,
+        "ne": 1,
+        "gt": 1,
+        "lt": 1,
+        "gte": 1,
+        "lte": 1,
+        "between": 2,
+        "not_between": 2,
+        "in": 1,
+        "not_in": 1,
+        "contains_any": 3,
+        "contains_all": 3,
+        "startswith": 2,
+        "endswith": 2,
+        "contains": 3,
+        "iexact": 4,
+        "istartswith": 4,
+        "iendswith": 4,
+        "icontains": 5,
+        "regex": 8
+    }
+
+    # cost of operators missing in operator_cost.
+    default_operator_cost = 5
+
+    # case insensitive operators which are compiled into case sensitive
+    # ones applied to lowercased values.
+    lowered_operators = {
+        "iexact": "exact",
+        "istartswith": "startswith",
+        "iendswith": "endswith",
+        "icontains": "contains"
+    }
+
+    # substring operators which results PipeIndex finds for all pipes at once.
+    substring_operators = ("contains", "icontains")
+
+    # regex flags which can be set in condition as string of letters.
+    regex_flags = {
+        "i": re.IGNORECASE,
+        "m": re.MULTILINE,
+        "s": re.DOTALL,
+        "x": re.VERBOSE,
+        "u": re.UNICODE
+    }
+
+    # LRUCache instance for compiled regex patterns or None to disable it.
+    regex_cache = None
+
+    def compile_regex(self, condition_value):
+        """
+        Return function which matches string against regex condition value.
+        Condition value is a pattern string or dictionary like:
+        {"pattern": "github", "method": "search", "flags": "i"}
+        where method is one of "match" (default), "search" or "fullmatch".
+        """
+        if isinstance(condition_value, _pattern_type):
+            # already compiled pattern.
+            return condition_value.match
+        if isinstance(condition_value, dict):
+            pattern = condition_value["pattern"]
+            method = condition_value.get("method", "match")
+            flags = condition_value.get("flags", "")
+        else:
+            pattern, method, flags = condition_value, "match", ""
+        if method not in ("match", "search", "fullmatch"):
+            raise ValueError('Unsupported regex method %s' % method)
+
+        cache = self.regex_cache
+        cache_key = (pattern, method, flags)
+        if cache is not None:
+            matcher = cache.get(cache_key, None)
+            if matcher is not None:
+                return matcher
+
+        re_flags = 0
+        for flag in flags:
+            try:
+                re_flags |= self.regex_flags[flag]
+            except KeyError:
+                raise ValueError('Unsupported regex flag %s' % flag)
+        if method == "fullmatch" and not hasattr(re, 'fullmatch'):
+            # Python 2 has no fullmatch - anchor pattern at the end.
+            pattern, method = r'(?:%s)\Z' % pattern, "match"
+        matcher = getattr(re.compile(pattern, re_flags), method)
+
+        if cache is not None:
+            cache.set(cache_key, matcher)
+        return matcher
+
+    def prepare_match_regex(self, condition_value, value_type, value_format):
+        return self.compile_regex(condition_value)
+
+    def prepare_match_between(self, condition_value, value_type, value_format):
+        """
+        Return Range of [low, high] condition value.
+        """
+        if isinstance(condition_value, Range):
+            return condition_value
+        if not isinstance(condition_value, (list, tuple)) or \
+                len(condition_value) != 2:
+            raise ValueError('between needs [low, high] condition value')
+        low, high = [
+            self.convert_cached(value, value_type, value_format)
+            for value in condition_value
+        ]
+        return Range(low, high)
+
+    prepare_match_not_between = prepare_match_between
+
+    def make_match_between(self, obj_value, condition_value):
+        if type(condition_value) is not Range:
+            condition_value = self.prepare_match_between(
+                condition_value, None, None)
+        return obj_value in condition_value
+
+    def make_match_not_between(self, obj_value, condition_value):
+        return not self.make_match_between(obj_value, condition_value)
+
+    def prepare_match_in(self, condition_value, value_type, value_format):
+        """
+        Return frozenset of converted values of list condition value.
+        """
+        if isinstance(condition_value, frozenset):
+            return condition_value
+        if isinstance(condition_value, string_types) or \
+                not isinstance(condition_value, (list, tuple, set)):
+            raise ValueError('%r is not a list of values' % (condition_value,))
+        try:
+            return frozenset(
+                self.convert_cached(value, value_type, value_format)
+                for value in condition_value)
+        except TypeError:
+            raise ValueError('Values of %r must be hashable' % (condition_value,))
+
+    prepare_match_not_in = prepare_match_in
+    prepare_match_contains_any = prepare_match_in
+    prepare_match_contains_all = prepare_match_in
+
+    def make_match_in(self, obj_value, condition_value):
+        if type(condition_value) is not frozenset:
+            condition_value = self.prepare_match_in(condition_value, None, None)
+        try:
+            return obj_value in condition_value
+        except TypeError:
+            # unhashable value is not in set of hashable ones.
+            return False
+
+    def make_match_not_in(self, obj_value, condition_value):
+        return not self.make_match_in(obj_value, condition_value)
+
+    def make_match_contains_any(self, obj_value, condition_value):
+        """
+        Test if list value has at least one of condition values.
+        """
+        if type(condition_value) is not frozenset:
+            condition_value = self.prepare_match_in(condition_value, None, None)
+        if obj_value is None:
+            return False
+        if isinstance(obj_value, string_types):
+            obj_value = (obj_value,)
+        try:
+            return not condition_value.isdisjoint(obj_value)
+        except TypeError:
+            pass
+        try:
+            items = iter(obj_value)
+        except TypeError:
+            # not a list - it has no values.
+            return False
+        return any(self.make_match_in(item, condition_value)
+                   for item in items)
+
+    def make_match_contains_all(self, obj_value, condition_value):
+        """
+        Test if list value has all condition values.
+        """
+        if type(condition_value) is not frozenset:
+            condition_value = self.prepare_match_in(condition_value, None, None)
+        if obj_value is None:
+            return not condition_value
+        if isinstance(obj_value, string_types):
+            obj_value = (obj_value,)
+        try:
+            return condition_value.issubset(obj_value)
+        except TypeError:
+            pass
+        try:
+            items = iter(obj_value)
+        except TypeError:
+            # not a list - it has no values.
+            return not condition_value
+        return condition_value.issubset(
+            [item for item in items
+             if self.make_match_in(item, condition_value)])
+
     def make_match_exact(self, obj_value, condition_value):
         return obj_value == condition_value
 
@@ -107,8 +570,9 @@ class Match(object):
         return obj_value.lower() == condition_value.lower()
 
     def make_match_regex(self, obj_value, condition_value):
-        match = re.match(condition_value, obj_value)
-        return hasattr(match, 'group')
+        if not callable(condition_value):
+            condition_value = self.compile_regex(condition_value)
+        return condition_value(obj_value) is not None
 
     def make_match_startswith(self, obj_value, condition_value):
         return obj_value.startswith(condition_value)
@@ -146,6 +610,9 @@ class Match(object):
 
 class Alter(object):
 
+    # operators which change list values in place.
+    mutating_operators = ("append", "prepend")
+
     def make_alter_set(self, obj_value, alter_value, alter_info):
         return alter_value
 
@@ -156,7 +623,7 @@ class Alter(object):
             is_string = isinstance(obj_value, str)
 
         replacement = alter_info.get('replacement', '')
-        replacement = self.convert(
+        replacement = self.convert_cached(
             replacement,
             alter_info.get("type", None),
             alter_info.get("format", None)
@@ -195,16 +662,774 @@ class Alter(object):
         return obj_value + alter_value
 
 
+class Slotted(object):
+    """
+    Base class of compact objects with __slots__ which can be pickled with
+    any pickle protocol.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name != "__weakref__" and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state.update(getattr(self, "__dict__", {}))
+        return state
+
+    def __setstate__(self, state):
+        for name, value in pyiteritems(state):
+            setattr(self, name, value)
+
+
+class KeyPath(Slotted):
+    """
+    Nested key(attribute) path like "user.profile.locale" or
+    "meta.tags[0]" parsed once by Pipe.key_path. Value is read by function
+    generated for the path - a chain of dictionary lookups (attribute
+    lookups for ObjectPipe) and indexes. Objects of other structure are
+    walked step by step. Missing steps give None.
+
+    Top level key is accessed through methods of owner, nested steps are
+    dictionary keys, list indexes or attributes of other objects.
+    """
+    __slots__ = (
+        "owner", "key", "root", "steps", "source", "get", "__weakref__")
+
+    def __init__(self, owner, key, steps):
+        self.owner = owner
+        self.key = key
+        self.root = steps[0]
+        self.steps = steps
+        self.generate()
+
+    def expression(self):
+        """
+        Return expression reading path from obj or None if owner gets top
+        level values its own way.
+        """
+        method = self.owner.get_object_value
+        if _is_default(method, ObjectPipe):
+            attributes = True
+        elif _is_default(method, Pipe):
+            attributes = False
+        else:
+            return None
+        expression = "obj"
+        last = len(self.steps) - 1
+        for position, step in enumerate(self.steps):
+            if isinstance(step, int):
+                expression = "%s[%d]" % (expression, step)
+            elif attributes:
+                if _identifier.match(step) and not keyword.iskeyword(step):
+                    expression = "%s.%s" % (expression, step)
+                else:
+                    expression = "getattr(%s, %r)" % (expression, step)
+            elif position == last:
+                expression = "%s.get(%r)" % (expression, step)
+            else:
+                # missing step gives empty dictionary, so chain goes on.
+                expression = "%s.get(%r, _empty)" % (expression, step)
+        return expression
+
+    def generate(self):
+        expression = self.expression()
+        if expression is None:
+            self.source = None
+            self.get = self.walk
+            return
+        self.source = (
+            "def get(obj):\n"
+            "    try:\n"
+            "        return %s\n"
+            "    except (AttributeError, LookupError, TypeError):\n"
+            "        return walk(obj)\n" % expression
+        )
+        namespace = {"_empty": {}, "walk": self.walk}
+        exec(compile(self.source, "<path %s>" % self.key, "exec"), namespace)
+        self.get = namespace["get"]
+
+    def walk(self, obj):
+        """
+        Return value of path reading it step by step.
+        """
+        value = self.owner.get_object_value(obj, self.root)
+        for step in self.steps[1:]:
+            if value is None:
+                return None
+            value = _step_value(value, step)
+        return value
+
+    def parent(self, obj, copy_on_write=False, create=True):
+        """
+        Return container which holds the last step of path. Missing
+        dictionaries are created if create is True, otherwise None is
+        returned. If copy_on_write is True containers on the way are
+        copied, so containers shared with original object are not changed.
+
+        None is returned for paths which can not be set - missing lists or
+        indexes, values which are not containers. Object is not changed
+        then.
+        """
+        owner = self.owner
+        steps = self.steps
+        last = len(steps) - 1
+        # (position, holder, container) - containers to put into object.
+        replaced = []
+        holder, container = obj, owner.get_object_value(obj, self.root)
+        for position in range(1, len(steps)):
+            step = steps[position]
+            if container is None:
+                if not create or isinstance(step, int):
+                    return None
+                container = {}
+                replaced.append((position, holder, container))
+            elif not _can_set(container, step):
+                return None
+            elif copy_on_write:
+                container = copy(container)
+                replaced.append((position, holder, container))
+            if position == last:
+                break
+            holder, container = container, _step_value(container, step)
+        for position, holder, replacement in replaced:
+            if position == 1:
+                owner.set_object_key(holder, self.root, replacement)
+            else:
+                _set_step(holder, steps[position - 1], replacement)
+        return container
+
+    def set(self, obj, value, copy_on_write=False):
+        """
+        Set value of path in object (if path can be set).
+        """
+        parent = self.parent(obj, copy_on_write)
+        if parent is not None:
+            _set_step(parent, self.steps[-1], value)
+
+    def delete(self, obj, copy_on_write=False):
+        """
+        Delete the last step of path from object.
+        """
+        parent = self.parent(obj, create=False)
+        if parent is None:
+            return
+        if copy_on_write:
+            parent = self.parent(obj, copy_on_write)
+        _del_step(parent, self.steps[-1])
+
+    def __getstate__(self):
+        # generated function can not be pickled - it is generated again.
+        state = Slotted.__getstate__(self)
+        state.pop("get", None)
+        return state
+
+    def __setstate__(self, state):
+        Slotted.__setstate__(self, state)
+        self.generate()
+
+
+class Range(Slotted):
+    """
+    Inclusive range of between and not_between conditions with boundaries
+    converted once. Time range which low boundary is greater than high one
+    wraps - for example range from 21:00 to 09:00 includes midnight. Other
+    reversed ranges are errors.
+
+    Object values of time, datetime and date ranges can be datetimes or
+    numbers of seconds since Unix epoch (UTC). Epoch numbers are compared
+    with boundaries converted into seconds in advance - time of day of
+    epoch for time ranges - so there are no conversions at all.
+    """
+    __slots__ = ("low", "high", "wrap", "kind", "seconds")
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        # (low, high) in epoch seconds (seconds of day for time) or None.
+        self.seconds = None
+        if isinstance(low, datetime):
+            self.kind = "datetime"
+            self.seconds = (self.epoch(low), self.epoch(high))
+        elif isinstance(low, date):
+            self.kind = "date"
+        elif isinstance(low, time):
+            self.kind = "time"
+            self.seconds = (self.day_seconds(low), self.day_seconds(high))
+        else:
+            self.kind = None
+        self.wrap = low > high
+        if self.wrap and self.kind != "time":
+            raise ValueError('Reversed range %r - %r' % (low, high))
+
+    @staticmethod
+    def epoch(value):
+        return timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+    @staticmethod
+    def day_seconds(value):
+        return value.hour * 3600 + value.minute * 60 + value.second + \
+            value.microsecond / 1e6
+
+    def __contains__(self, value):
+        kind = self.kind
+        if kind is None:
+            low, high = self.low, self.high
+        elif type(value) in _number_types:
+            if kind == "time":
+                value = value % 86400
+            elif kind == "date":
+                value = (_epoch + timedelta(seconds=value)).date()
+            low, high = self.seconds or (self.low, self.high)
+        else:
+            if kind != "datetime" and isinstance(value, datetime):
+                value = value.time() if kind == "time" else value.date()
+            low, high = self.low, self.high
+        if self.wrap:
+            return value >= low or value <= high
+        return low <= value <= high
+
+    def __repr__(self):
+        return "Range(%r, %r)" % (self.low, self.high)
+
+
+class CompiledKey(Slotted):
+    """
+    Match section of one key(attribute) prepared by Pipe.compile: operator
+    methods are already bound and condition values already converted.
+
+    Values derived from object value (converted value, lowercased value,
+    substrings found by PipeIndex) are shared between pipes through memo -
+    dictionary which lives while one object is processed, so every value
+    is converted at most once per object however many pipes inspect it.
+    """
+    __slots__ = (
+        "key", "mode", "value_type", "value_format", "convert", "conditions",
+        "spec_conditions", "cache", "path", "value_key", "lower_key"
+    )
+
+    def __init__(self, key, mode, value_type, value_format, convert,
+                 conditions, spec_conditions=None, cache=False, path=None):
+        self.key = key
+        self.mode = mode
+        self.value_type = value_type
+        self.value_format = value_format
+        # callable to convert object value or None if no conversion needed.
+        self.convert = convert
+        # tuple of (operator, method, condition_value, lower, found_key)
+        # tuples. If lower is True method gets lowercased object value,
+        # found_key is memo key of substrings found in object value.
+        self.conditions = conditions
+        # (operator, condition_value) pairs as they are in specification
+        # or None if they are the same in conditions.
+        self.spec_conditions = spec_conditions
+        # True if object values are converted through conversion cache.
+        self.cache = cache
+        # KeyPath of nested key or None.
+        self.path = path
+        self.value_key = memo_key(key, path, "value", value_type, value_format)
+        self.lower_key = memo_key(key, path, "lower", value_type, value_format)
+
+    def to_dict(self):
+        """
+        Return match section of key as it is in pipe specification.
+        """
+        conditions = self.spec_conditions
+        if conditions is None:
+            conditions = [
+                (condition[0], condition[2]) for condition in self.conditions]
+        section = {
+            "mode": self.mode,
+            "conditions": [list(condition) for condition in conditions]
+        }
+        if self.value_type is not None:
+            section["type"] = self.value_type
+        if self.value_format is not None:
+            section["format"] = self.value_format
+        if self.cache:
+            section["cache"] = True
+        return section
+
+    def lower(self, object_value, memo):
+        """
+        Return lowercased object value computed once per memo.
+        """
+        if memo is None:
+            return object_value.lower()
+        lowered = memo.get(self.lower_key, _missing)
+        if lowered is _missing:
+            lowered = memo[self.lower_key] = object_value.lower()
+        return lowered
+
+    def check(self, object_value, memo=None):
+        """
+        Return True if object value satisfies conditions of this key.
+        """
+        if self.convert is not None:
+            if memo is None:
+                object_value = self.convert(object_value)
+            else:
+                converted = memo.get(self.value_key, _missing)
+                if converted is _missing:
+                    converted = memo[self.value_key] = self.convert(object_value)
+                object_value = converted
+        is_or = self.mode == Logic.OR
+        lowered = _missing
+        for _operator, method, condition_value, lower, found_key in self.conditions:
+            if lower:
+                if lowered is _missing:
+                    lowered = self.lower(object_value, memo)
+                value = lowered
+            else:
+                value = object_value
+            found = None
+            if found_key is not None and memo is not None:
+                found = memo.get(found_key)
+            if found is not None and condition_value in found[0]:
+                # substring search already done for all patterns at once.
+                is_matched = condition_value in found[1]
+            else:
+                is_matched = method(value, condition_value)
+            if bool(is_matched) == is_or:
+                return is_or
+        return not is_or
+
+
+class CompiledPipe(Slotted):
+    """
+    Pipe validated and prepared once by Pipe.compile. Applying it to an
+    object does not touch pipe specification anymore - just key lookups
+    and direct calls of bound operator methods.
+
+    Specification itself is not kept - to_dict returns it back.
+    """
+    __slots__ = (
+        "owner", "id", "priority", "mode", "keys", "drop", "alters",
+        "altered_keys", "paths", "get_object_value", "set_object_key",
+        "__weakref__"
+    )
+
+    def __init__(self, owner, spec, priority, mode, keys, drop, alters):
+        self.owner = owner
+        # optional identifier of pipe from specification.
+        self.id = spec.get("id", None)
+        self.priority = priority
+        self.mode = mode
+        # tuple of CompiledKey instances.
+        self.keys = keys
+        # drop section of alter or None.
+        self.drop = drop
+        # tuple of (operator, method, key, alter_value, alter_info) tuples.
+        self.alters = alters
+        # keys(attributes) this pipe can change or delete - top level keys
+        # of key paths.
+        changed = [alter[2] for alter in alters]
+        if isinstance(drop, list):
+            changed.extend(drop)
+        # changed key path -> KeyPath or None if there are no key paths.
+        self.paths = None
+        altered_keys = set()
+        for key in changed:
+            path = owner.key_path(key)
+            if path is None:
+                altered_keys.add(key)
+            else:
+                altered_keys.add(path.root)
+                if self.paths is None:
+                    self.paths = {}
+                self.paths[key] = path
+        self.altered_keys = owner.intern(frozenset(altered_keys))
+        self.get_object_value = owner.shared_method("get_object_value")
+        self.set_object_key = owner.shared_method("set_object_key")
+
+    def to_dict(self):
+        """
+        Return pipe specification.
+        """
+        spec = {
+            "priority": self.priority,
+            "mode": self.mode,
+            "match": dict((key.key, key.to_dict()) for key in self.keys)
+        }
+        if self.id is not None:
+            spec["id"] = self.id
+        alter = {}
+        if self.drop:
+            # copies - alter infos and drop list are shared by pipes.
+            alter["drop"] = list(self.drop) if isinstance(self.drop, list) \
+                else self.drop
+        for operator, _method, key, _alter_value, alter_info in self.alters:
+            alter.setdefault(operator, {})[key] = dict(alter_info)
+        if alter:
+            spec["alter"] = alter
+        return spec
+
+    @property
+    def spec(self):
+        return self.to_dict()
+
+    def match(self, obj, memo=None):
+        """
+        Return True if object matches conditions from match section.
+        """
+        get_object_value = self.get_object_value
+        if self.mode == Logic.OR:
+            for key in self.keys:
+                if key.path is not None:
+                    value = key.path.get(obj)
+                else:
+                    value = get_object_value(obj, key.key)
+                if key.check(value, memo):
+                    return True
+            return False
+        for key in self.keys:
+            if key.path is not None:
+                value = key.path.get(obj)
+            else:
+                value = get_object_value(obj, key.key)
+            if not key.check(value, memo):
+                return False
+        return True
+
+    def alter(self, obj, memo=None, copy_on_write=False):
+        """
+        Modify matched object according to alter section.
+
+        If copy_on_write is True object is left untouched - its shallow copy
+        is modified and returned, so unchanged values are shared with
+        original object. Lists changed by mutating operators (like append)
+        are copied too.
+        """
+        if copy_on_write:
+            if self.drop and not isinstance(self.drop, list):
+                # the whole object is dropped - nothing to copy.
+                return None
+            obj = self.owner.copy_object(obj)
+        paths = self.paths
+        if self.drop:
+            if paths is not None and isinstance(self.drop, list):
+                for key in self.drop:
+                    if key in paths:
+                        paths[key].delete(obj, copy_on_write)
+                    else:
+                        obj = self.owner.alter_delete(obj, [key])
+            else:
+                obj = self.owner.alter_delete(obj, self.drop)
+            if not obj:
+                return obj
+        get_object_value = self.get_object_value
+        set_object_key = self.set_object_key
+        mutating = self.owner.mutating_operators
+        for operator, method, key, alter_value, alter_info in self.alters:
+            path = paths.get(key) if paths is not None else None
+            if path is None:
+                obj_value = get_object_value(obj, key)
+            else:
+                obj_value = path.get(obj)
+            if copy_on_write and operator in mutating and isinstance(obj_value, list):
+                obj_value = list(obj_value)
+            obj_value = method(obj_value, alter_value, alter_info)
+            if path is None:
+                set_object_key(obj, key, obj_value)
+            else:
+                # containers on the way are copied too.
+                path.set(obj, obj_value, copy_on_write)
+        if memo:
+            forget(memo, self.altered_keys)
+        return obj
+
+    def apply(self, obj, memo=None, copy_on_write=False):
+        """
+        Apply pipe for obj - the same as Pipe.apply but without
+        interpreting pipe specification.
+        """
+        if not self.keys:
+            # we have no match conditions, so just return object back.
+            return obj
+        if not self.match(obj, memo):
+            return obj
+        return self.alter(obj, memo, copy_on_write)
+
+
+class InstrumentedCompiledPipe(CompiledPipe):
+    """
+    CompiledPipe which counts calls, matches, drops and time spent in it.
+    Instrumented Pipe compiles pipes into this class.
+    """
+    # counter dictionary from Stats.
+    __slots__ = ("counter",)
+
+    def match(self, obj, memo=None):
+        started = timer()
+        is_matched = CompiledPipe.match(self, obj, memo)
+        counter = self.counter
+        counter["time"] += timer() - started
+        counter["calls"] += 1
+        counter["matched" if is_matched else "not_matched"] += 1
+        return is_matched
+
+    def alter(self, obj, memo=None, copy_on_write=False):
+        started = timer()
+        obj = CompiledPipe.alter(self, obj, memo, copy_on_write)
+        counter = self.counter
+        counter["time"] += timer() - started
+        if not obj:
+            counter["dropped"] += 1
+        return obj
+
+
 class Pipe(Match, Alter, Converter):
     """
     This is a basic Pipe class for dictionaries.
+
+    Converted condition values are kept in LRU cache of
+    conversion_cache_size items, compiled regex patterns - in LRU cache of
+    regex_cache_size items (0 disables cache). If reorder is True
+    compiled pipes check cheap keys and conditions (like exact) before
+    expensive ones (like regex or datetime conversion). If index is True
+    process evaluates only pipes which can match object (see PipeIndex).
+
+    If instrument is True pipes are compiled with counters of calls,
+    matches, drops and time per pipe, per operator and per conversion
+    type - see stats.snapshot(). Without it there are no counters at all.
+
+    If copy_on_write is True apply and process never modify objects passed
+    to them: altered objects are shallow copies sharing unchanged values
+    with originals.
+
+    If codegen is True (and pipe is not instrumented) pipes are compiled
+    into generated Python functions - see GeneratedPipe.
+
+    If key_paths is True keys like "user.profile.locale" or "meta.tags[0]"
+    in match and alter sections are paths to nested values - see KeyPath.
+
+    If result_cache_size is set, process remembers which pipes matched
+    objects in LRU cache keyed by values of keys read by match sections,
+    so objects with the same values are only altered by these pipes -
+    without matching. Match results must depend on these values only.
+
+    Pipe can be shared by many threads: pipes and index are never changed
+    in place, process only reads them and keeps its state in memo.
+    Updates replace them with new ones at once (see update_pipes).
+    Counters of instrumented pipe are not synchronized, so they are
+    approximate under concurrent use.
     """
-    def __init__(self, pipes=[]):
-        self.pipes = []
-        for pipe in pipes:
-            pipe = self.load_pipe(pipe)
-            priority = pipe.get('priority', 0)
-            heappush(self.pipes, (priority, pipe))
+    # reorder keys and conditions of compiled pipes by cost.
+    reorder = False
+
+    # Stats of instrumented pipe or None.
+    stats = None
+
+    # return altered copies instead of modifying objects.
+    copy_on_write = False
+
+    # compile pipes into generated functions.
+    codegen = False
+
+    # LRUCache of generated code by hash of pipe specification or None.
+    code_cache = None
+
+    # treat keys with dots and indexes as paths to nested values.
+    key_paths = False
+
+    # LRUCache of matched pipes by values of read keys or None.
+    result_cache = None
+
+    # LRUCache of pipes compiled by apply or None.
+    apply_cache = None
+
+    def __init__(self, pipes=[], conversion_cache_size=1024, reorder=False,
+                 regex_cache_size=1024, index=False, instrument=False,
+                 copy_on_write=False, codegen=False, key_paths=False,
+                 result_cache_size=0, apply_cache_size=256):
+        self.reorder = reorder
+        self.copy_on_write = copy_on_write
+        self.codegen = codegen
+        self.key_paths = key_paths
+        if codegen:
+            self.code_cache = LRUCache(1024)
+        if instrument:
+            self.stats = Stats()
+        if conversion_cache_size:
+            self.conversion_cache = LRUCache(conversion_cache_size)
+        if regex_cache_size:
+            self.regex_cache = LRUCache(regex_cache_size)
+        if apply_cache_size:
+            self.apply_cache = LRUCache(apply_cache_size)
+        # serializes updates of pipes, process never waits for it.
+        self.update_lock = threading.RLock()
+        # bound (and timed) methods shared by all compiled pipes instead
+        # of a copy per pipe.
+        self.methods = {}
+        # memo keys and sets of keys(attributes) shared by compiled pipes.
+        # They are made of keys, value types and formats only.
+        self.interned = {}
+        # key path -> KeyPath parsed once and sorted items -> AlterInfo,
+        # while some pipe uses them.
+        self.paths = weakref.WeakValueDictionary()
+        self.alter_infos = weakref.WeakValueDictionary()
+        # tuple of compiled pipes sorted by priority, pipes with equal
+        # priority keep their order.
+        self.pipes = tuple(
+            sorted([self.compile(pipe) for pipe in pipes], key=_priority_of))
+        # id -> compiled pipe with this id.
+        self.pipe_ids = {}
+        for pipe in self.pipes:
+            self.register_id(self.pipe_ids, pipe)
+        # pipe -> (priority, sequence number) - position of pipe in pipes.
+        self.pipe_order = dict(
+            (pipe, (pipe.priority, sequence))
+            for sequence, pipe in enumerate(self.pipes))
+        # sequence number of next added pipe.
+        self.sequence = len(self.pipes)
+        self.index = None
+        if index:
+            from .index import PipeIndex
+            self.index = PipeIndex(self, self.pipes)
+        if result_cache_size:
+            self.result_cache = LRUCache(result_cache_size)
+            self.reset_results()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("update_lock", None)
+        # weak dictionaries can not be pickled - they are filled again.
+        state.pop("paths", None)
+        state.pop("alter_infos", None)
+        if self.code_cache is not None:
+            # code objects can not be pickled - pipes are generated again.
+            state["code_cache"] = LRUCache(self.code_cache.maxsize)
+        if self.result_cache is not None:
+            state["result_cache"] = LRUCache(self.result_cache.maxsize)
+        if self.apply_cache is not None:
+            # keeps specifications of caller.
+            state["apply_cache"] = LRUCache(self.apply_cache.maxsize)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.update_lock = threading.RLock()
+        self.paths = weakref.WeakValueDictionary()
+        self.alter_infos = weakref.WeakValueDictionary()
+
+    def register_id(self, pipe_ids, pipe):
+        if pipe.id is None:
+            return
+        if pipe.id in pipe_ids:
+            raise ValueError('Duplicate pipe id %s' % pipe.id)
+        pipe_ids[pipe.id] = pipe
+
+    def add_pipe(self, pipe):
+        """
+        Add pipe (specification or CompiledPipe) and return compiled pipe.
+        It goes after pipes with the same priority.
+        """
+        pipe = self.compile(pipe)
+        self.update_pipes(added=[pipe])
+        return pipe
+
+    def remove_pipe(self, pipe_id):
+        """
+        Remove pipe with given id (or CompiledPipe itself) and return it.
+        """
+        with self.update_lock:
+            pipe = self.get_pipe(pipe_id)
+            self.update_pipes(removed=[pipe])
+        return pipe
+
+    def replace_pipe(self, pipe_id, pipe):
+        """
+        Replace pipe with given id (or CompiledPipe itself) with new pipe
+        in one update and return compiled new pipe.
+        """
+        pipe = self.compile(pipe)
+        with self.update_lock:
+            self.update_pipes(added=[pipe], removed=[self.get_pipe(pipe_id)])
+        return pipe
+
+    def get_pipe(self, pipe_id):
+        if isinstance(pipe_id, CompiledPipe):
+            return pipe_id
+        try:
+            return self.pipe_ids[pipe_id]
+        except KeyError:
+            raise KeyError('No pipe with id %s' % pipe_id)
+
+    def update_pipes(self, added=(), removed=()):
+        """
+        Remove and add compiled pipes. Nothing is built again: pipes are
+        put in place by binary search and only index groups of these pipes
+        are changed. New list of pipes and new index replace old ones at
+        once, so process running meanwhile sees either old or new pipes.
+        Updates from many threads are applied one by one.
+        """
+        with self.update_lock:
+            self._update_pipes(added, removed)
+
+    def _update_pipes(self, added, removed):
+        # pipe_ids and pipe_order are used by updates only, so they are
+        # changed in place - after all checks.
+        order = self.pipe_order
+        pipe_ids = self.pipe_ids
+        removed_set = set()
+        for pipe in removed:
+            if pipe not in order:
+                raise ValueError('Pipe is not in pipes')
+            if pipe in removed_set:
+                raise ValueError('Pipe is removed twice')
+            removed_set.add(pipe)
+        added_ids = {}
+        added_set = set()
+        for pipe in added:
+            if pipe in order:
+                raise ValueError('Pipe is already in pipes')
+            if pipe in added_set:
+                raise ValueError('Pipe is added twice')
+            added_set.add(pipe)
+            self.register_id(added_ids, pipe)
+            current = pipe_ids.get(pipe.id)
+            if current is not None and current not in removed_set:
+                raise ValueError('Duplicate pipe id %s' % pipe.id)
+        pipes = list(self.pipes)
+        keys = _OrderKeys(pipes, order)
+        for pipe in removed:
+            del pipes[bisect_left(keys, order[pipe])]
+        sequenced = []
+        for pipe in added:
+            key = (pipe.priority, self.sequence)
+            pipes.insert(bisect_right(keys, key), pipe)
+            sequenced.append((pipe, self.sequence))
+            self.sequence += 1
+            order[pipe] = key
+        for pipe in removed:
+            del order[pipe]
+            if pipe_ids.get(pipe.id) is pipe:
+                del pipe_ids[pipe.id]
+        for pipe in added:
+            self.register_id(pipe_ids, pipe)
+        index = self.index
+        if index is not None:
+            index = index.update(sequenced, removed)
+        self.pipes, self.index = tuple(pipes), index
+        if self.result_cache is not None:
+            self.reset_results()
+
+    def reset_results(self):
+        """
+        Forget cached results of pipes. Called when pipes change.
+        """
+        keys = []
+        seen = set()
+        for pipe in self.pipes:
+            for compiled_key in pipe.keys:
+                if compiled_key.key not in seen:
+                    seen.add(compiled_key.key)
+                    keys.append((compiled_key.key, compiled_key.path))
+        # cached results are valid for this state only - results computed
+        # by process running meanwhile with old pipes are not used.
+        self.result_state = (self.pipes, self.index, tuple(keys))
+        self.result_cache.clear(reset=False)
 
     def load_pipe(self, pipe):
         """
@@ -215,6 +1440,302 @@ class Pipe(Match, Alter, Converter):
         else:
             return json.loads(pipe)
 
+    def compile(self, pipe, shared=True):
+        """
+        Validate pipe once and return CompiledPipe which can be applied to
+        many objects without interpreting pipe specification again.
+
+        Keys and values of compiled pipe are shared with other pipes and
+        code is generated for it (if codegen is on) unless shared is False -
+        pipe is applied once.
+        """
+        if isinstance(pipe, CompiledPipe):
+            return pipe
+        pipe = self.load_pipe(pipe)
+        if not isinstance(pipe, dict):
+            raise TypeError('pipe must be dict or json string')
+        keys = self.compile_match(pipe.get("match", None) or {}, shared)
+        drop, alters = self.compile_alter(pipe.get("alter", None), shared)
+        if self.stats is not None:
+            pipe_class = InstrumentedCompiledPipe
+        elif self.codegen and shared:
+            from .codegen import GeneratedPipe
+            pipe_class = GeneratedPipe
+        else:
+            pipe_class = CompiledPipe
+        compiled = pipe_class(
+            self,
+            pipe,
+            pipe.get("priority", 0),
+            pipe.get("mode", Logic.AND),
+            keys,
+            drop,
+            alters
+        )
+        if self.stats is not None:
+            compiled.counter = self.stats.counter(
+                "pipes",
+                compiled.id if compiled.id is not None else spec_hash(pipe),
+                "matched", "not_matched", "dropped"
+            )
+        return compiled
+
+    def shared_method(self, name, counter_name=None, count_matched=False):
+        """
+        Return bound method (wrapped into TimedCall named counter_name if
+        pipe is instrumented) shared by all compiled pipes or None if
+        there is no such method.
+        """
+        methods = self.methods
+        method_key = (name, counter_name)
+        method = methods.get(method_key)
+        if method is None:
+            method = getattr(self, name, None)
+            if method is None:
+                return None
+            if counter_name is not None:
+                method = self.timed(
+                    "operators", counter_name, method, count_matched)
+            methods[method_key] = method
+        return method
+
+    def intern(self, value):
+        """
+        Return string (memo key tuple or frozenset of keys) equal to given
+        one shared by all compiled pipes. Interned strings are freed when
+        nothing uses them, tuples and frozensets are made of keys only.
+        Other values are returned as they are.
+        """
+        if type(value) is str:
+            return _intern(value)
+        if type(value) in (tuple, frozenset):
+            return self.interned.setdefault(value, value)
+        return value
+
+    def alter_info(self, alter_info):
+        """
+        Return AlterInfo copy of alter section of key shared by compiled
+        pipes with equal alter sections.
+        """
+        try:
+            items = tuple(sorted(alter_info.items()))
+            shared = self.alter_infos.get(items)
+        except TypeError:
+            # unhashable or unorderable values.
+            return AlterInfo(alter_info)
+        if shared is None:
+            shared = AlterInfo(alter_info)
+            self.alter_infos[items] = shared
+        return shared
+
+    def key_path(self, key):
+        """
+        Return KeyPath of nested key like "user.profile.locale" parsed
+        once, None for top level key or if key_paths is not enabled.
+        """
+        if not self.key_paths or not isinstance(key, string_types) or \
+                ("." not in key and "[" not in key):
+            return None
+        path = self.paths.get(key)
+        if path is None:
+            steps = tuple(
+                self.intern(step) if isinstance(step, string_types) else step
+                for step in parse_key_path(key))
+            path = self.paths.setdefault(key, KeyPath(self, key, steps))
+        return path
+
+    def timed(self, section, name, function, count_matched=False):
+        """
+        Wrap function into TimedCall if pipe is instrumented.
+        """
+        if self.stats is None:
+            return function
+        if count_matched:
+            counter = self.stats.counter(section, name, "matched")
+        else:
+            counter = self.stats.counter(section, name)
+        return TimedCall(function, counter, count_matched)
+
+    def compile_match(self, match_section, shared=True):
+        """
+        Return list of CompiledKey for every key in match section.
+        """
+        keys = []
+        for key, match_key_section in pyiteritems(match_section):
+            keys.append(self.compile_key(key, match_key_section, shared))
+        if self.reorder:
+            keys.sort(key=self.key_cost)
+        return tuple(keys)
+
+    def operator_cost_of(self, operator):
+        """
+        Return relative cost of match operator.
+        """
+        return self.operator_cost.get(operator, self.default_operator_cost)
+
+    def key_cost(self, compiled_key):
+        """
+        Return relative cost of checking CompiledKey: cost of object
+        value conversion plus cost of all its conditions.
+        """
+        cost = 0
+        if compiled_key.value_type:
+            cost += self.conversion_cost.get(compiled_key.value_type, 1)
+        for condition in compiled_key.conditions:
+            cost += self.operator_cost_of(condition[0])
+        return cost
+
+    def lowered_operator(self, operator):
+        """
+        Return case sensitive operator case insensitive operator is checked
+        with on lowercased values or None. Operators with overriden methods
+        are not lowered.
+        """
+        lowered_operator = self.lowered_operators.get(operator)
+        if lowered_operator is None:
+            return None
+        for name in (operator, lowered_operator):
+            if not _is_default(getattr(self, "make_match_%s" % name), Match):
+                return None
+        return lowered_operator
+
+    def compile_key(self, key, match_key_section, shared=True):
+        """
+        Bind operator methods and convert condition values of one key.
+        """
+        conditions = match_key_section.get("conditions", [])
+        if not isinstance(conditions, list):
+            raise TypeError('conditions must be list')
+        intern = self.intern if shared else _unshared
+        key = intern(key)
+        path = self.key_path(key)
+        value_type = match_key_section.get("type", None)
+        value_format = match_key_section.get("format", None)
+
+        compiled_conditions = []
+        spec_conditions = []
+        for operator, condition_value in conditions:
+            operator = intern(operator)
+            if isinstance(condition_value, string_types):
+                condition_value = intern(condition_value)
+            spec_conditions.append((operator, condition_value))
+            method = self.shared_method(
+                "make_match_%s" % operator, "make_match_%s" % operator, True)
+            if not method:
+                raise ValueError('Unsupported operator %s' % operator)
+            prepare = getattr(self, "prepare_match_%s" % operator, None)
+            if prepare is not None:
+                condition_value = prepare(
+                    condition_value, value_type, value_format)
+            else:
+                condition_value = self.convert_cached(
+                    condition_value, value_type, value_format)
+            lower = False
+            lowered_operator = self.lowered_operator(operator)
+            if lowered_operator is not None and \
+                    isinstance(condition_value, string_types):
+                # lowercased object value is computed once and shared.
+                lower = True
+                condition_value = intern(condition_value.lower())
+                method = self.shared_method(
+                    "make_match_%s" % lowered_operator,
+                    "make_match_%s" % operator, True)
+            found_key = None
+            if operator in self.substring_operators:
+                found_key = intern(memo_key(
+                    key, path, "found", lower, value_type, value_format))
+            compiled_conditions.append(
+                (operator, method, condition_value, lower, found_key))
+
+        if self.reorder:
+            # sort is stable so conditions of equal cost keep their order.
+            compiled_conditions.sort(
+                key=lambda condition: self.operator_cost_of(condition[0]))
+
+        cache = match_key_section.get("cache", False)
+        convert = None
+        if value_type:
+            convert = self.converter(value_type, value_format, cache)
+
+        if all(compiled[0] is spec[0] and compiled[2] is spec[1]
+               for compiled, spec in zip(compiled_conditions, spec_conditions)):
+            # nothing is converted - specification is in conditions.
+            spec_conditions = None
+        compiled_key = CompiledKey(
+            key,
+            match_key_section.get("mode", Logic.AND),
+            value_type,
+            value_format,
+            convert,
+            tuple(compiled_conditions),
+            spec_conditions and tuple(spec_conditions),
+            cache,
+            path
+        )
+        compiled_key.value_key = intern(compiled_key.value_key)
+        compiled_key.lower_key = intern(compiled_key.lower_key)
+        return compiled_key
+
+    def converter(self, value_type, value_format, cache=False):
+        """
+        Return function converting object values to value_type shared by
+        all compiled keys.
+        """
+        methods = self.methods
+        method_key = ("converter", value_type, value_format, cache)
+        convert = methods.get(method_key)
+        if convert is None:
+            # object values with low cardinality can opt in to cache.
+            if cache:
+                convert = self.convert_cached
+            else:
+                convert = self.convert
+            convert = partial(
+                convert, value_type=value_type, value_format=value_format)
+            if value_type in ("datetime", "date", "time"):
+                # epoch seconds are compared as they are.
+                convert = partial(_convert_moment, convert)
+            convert = self.timed("conversions", value_type, convert)
+            methods[method_key] = convert
+        return convert
+
+    def compile_alter(self, alter_section, shared=True):
+        """
+        Return drop section and list of prepared alter operators.
+        """
+        if not alter_section or not isinstance(alter_section, dict):
+            return None, ()
+        intern = self.intern if shared else _unshared
+        drop = alter_section.get("drop", None)
+        if isinstance(drop, list):
+            # own copy - specification can be changed by caller later.
+            drop = [intern(key) for key in drop]
+        alters = []
+        for operator, key_section in pyiteritems(alter_section):
+            if operator == "drop":
+                continue
+            operator = intern(operator)
+            method = self.shared_method(
+                "make_alter_%s" % operator, "make_alter_%s" % operator)
+            if not method:
+                raise ValueError('Unsupported alter operator %s' % operator)
+            for key, alter_info in pyiteritems(key_section):
+                alter_value = self.convert_cached(
+                    alter_info.get('value', None),
+                    alter_info.get('type', None),
+                    alter_info.get('format', None)
+                )
+                if isinstance(alter_value, string_types):
+                    alter_value = intern(alter_value)
+                # own copy - specification can be changed by caller later.
+                if shared:
+                    alter_info = self.alter_info(alter_info)
+                else:
+                    alter_info = dict(alter_info)
+                alters.append(
+                    (operator, method, intern(key), alter_value, alter_info))
+        return drop, tuple(alters)
+
     def get_object_value(self, obj, key):
         """
         This is for object of type dict. This method must be overriden
@@ -222,6 +1743,12 @@ class Pipe(Match, Alter, Converter):
         """
         return obj.get(key, None)
 
+    def copy_object(self, obj):
+        """
+        Return shallow copy of dictionary.
+        """
+        return obj.copy()
+
     def del_object_key(self, obj, key):
         """
         Delete key from dictionary.
@@ -245,43 +1772,197 @@ class Pipe(Match, Alter, Converter):
 
     def process(self, obj):
         """
-        Pull object through pipes and return it.
+        Pull object through pipes and return it. Pipes are not consumed so
+        process can be called many times.
         """
         if obj is None:
             return obj
-        if not self.pipes:
-            return obj
-        for i in xrange(len(self.pipes)):
-            _priority, pipe = heappop(self.pipes)
-            obj = self.apply(obj, pipe)
+        if self.result_cache is not None and obj:
+            return self.process_cached(obj)
+        # index and pipes can be replaced by update meanwhile - so they
+        # are read once.
+        index = self.index
+        if index is not None:
+            return index.process(obj, None, self.copy_on_write)
+        memo = {}
+        copy_on_write = self.copy_on_write
+        for pipe in self.pipes:
+            obj = pipe.apply(obj, memo, copy_on_write)
             if not obj:
                 return None
         return obj
 
+    def process_cached(self, obj):
+        """
+        Pull object through pipes which matched object with the same
+        values of read keys before. Object is processed by all pipes and
+        matched pipes are cached if it is not found in result cache.
+        """
+        state = self.result_state
+        pipes, index, keys = state
+        get_object_value = self.get_object_value
+        values = tuple([
+            get_object_value(obj, key) if path is None else path.get(obj)
+            for key, path in keys
+        ])
+        # 1, 1.0 and True are equal but can match differently.
+        cache_key = values + tuple(map(type, values))
+        cache = self.result_cache
+        copy_on_write = self.copy_on_write
+        try:
+            cached = cache.get(cache_key)
+        except TypeError:
+            # unhashable value - object is not cached.
+            cache_key, cached = None, None
+        if cached is not None and cached[0] is state:
+            for pipe in cached[1]:
+                obj = pipe.alter(obj, None, copy_on_write)
+                if not obj:
+                    return None
+            return obj
+        matched = []
+        memo = {}
+        if index is not None:
+            obj = index.process(obj, memo, copy_on_write, matched)
+        else:
+            for pipe in pipes:
+                if pipe.keys and pipe.match(obj, memo):
+                    matched.append(pipe)
+                    obj = pipe.alter(obj, memo, copy_on_write)
+                    if not obj:
+                        obj = None
+                        break
+        if cache_key is not None and not any(pipe.paths for pipe in matched):
+            # alters of key paths are skipped for objects of other shape,
+            # so pipes matched after them depend on more than read values.
+            cache.set(cache_key, (state, tuple(matched)))
+        return obj
+
+    def process_many(self, objects, skip_none=False):
+        """
+        Generator which pulls every object from iterable through pipes and
+        yields results lazily in the same order. Set skip_none to True to
+        not yield dropped objects.
+        """
+        if self.result_cache is not None:
+            for obj in objects:
+                obj = self.process(obj)
+                if obj is None and skip_none:
+                    continue
+                yield obj
+            return
+        index = self.index
+        if index is not None:
+            # without pipes objects are not dropped even if empty.
+            applies = [index.process] if index.order else []
+        else:
+            applies = [pipe.apply for pipe in self.pipes]
+        copy_on_write = self.copy_on_write
+        for obj in objects:
+            if obj is not None:
+                memo = {}
+                for apply in applies:
+                    obj = apply(obj, memo, copy_on_write)
+                    if not obj:
+                        obj = None
+                        break
+            if obj is None and skip_none:
+                continue
+            yield obj
+
+    def load_json(self, data):
+        """
+        Decode JSON message (bytes or string) into object.
+        """
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+    def dump_json(self, obj, data):
+        """
+        Encode altered object into JSON message of the same type as
+        original message data.
+        """
+        encoded = json.dumps(obj)
+        if isinstance(data, bytes) and not isinstance(encoded, bytes):
+            encoded = encoded.encode("utf-8")
+        return encoded
+
+    def process_json(self, data):
+        """
+        Pull JSON message (bytes or string) through pipes. Return data
+        itself if no pipe matched message, None if it was dropped and
+        encoded altered object otherwise. Decoded object is private, so it
+        is altered in place and never copied.
+        """
+        if data is None:
+            return data
+        obj = self.load_json(data)
+        if not obj:
+            obj = self.process(obj)
+            return None if obj is None else self.dump_json(obj, data)
+        index = self.index
+        memo = {}
+        if index is not None:
+            pipes = index.candidates(obj, memo)
+        else:
+            pipes = self.pipes
+        for position, pipe in enumerate(pipes):
+            if pipe.keys and pipe.match(obj, memo):
+                break
+        else:
+            # message passes through as it is - nothing to encode.
+            return data
+        if index is not None:
+            obj = index.pull(obj, memo, pipes[position:], matched=True)
+        else:
+            obj = pipe.alter(obj, memo)
+            for pipe in pipes[position + 1:]:
+                if not obj:
+                    break
+                obj = pipe.apply(obj, memo)
+        if not obj:
+            return None
+        return self.dump_json(obj, data)
+
     def apply(self, obj, pipe):
         """
         Apply pipe for obj.
         This process consists of two stages:
         - matching (make sure that object satisfies conditions in match section of pipe)
         - modifying (update object keys(attributes), add new or delete some of them)
-        """
-        pipe = self.load_pipe(pipe)
-        match_section = pipe.get("match", None)
-        if not match_section:
-            # we have no match conditions, so just return object back.
-            return obj
 
-        # get general logic operator for all keys(attributes).
-        mode = pipe.get("mode", Logic.AND)
+        Pipe can be json string, dictionary or CompiledPipe returned by
+        compile method - compile pipe once if you apply it many times.
+        """
+        return self.compile_once(pipe).apply(obj, None, self.copy_on_write)
 
-        is_matched = self.check_match(obj, match_section, mode=mode)
-        if not is_matched:
-            # no match with object. We do not need change it, so just return it
-            # back.
-            return obj
+    def compile_once(self, pipe):
+        """
+        Return compiled pipe for pipe applied by apply method.
 
-        # object matched! go to next stage - modify it.
-        return self.alter(obj, pipe)
+        Pipes applied again are compiled once and kept in apply_cache: json
+        strings by themselves, dictionaries by identity together with a
+        copy, so changed dictionaries are compiled again. Pipe applied for
+        the first time is not shared with other pipes.
+        """
+        cache = self.apply_cache
+        if cache is None or not isinstance(pipe, (dict, string_types)):
+            return self.compile(pipe)
+        is_dict = isinstance(pipe, dict)
+        cache_key = id(pipe) if is_dict else pipe
+        entry = cache.get(cache_key)
+        if entry is None or (is_dict and entry[0] is not pipe):
+            # remember pipe - it is compiled for reuse if applied again.
+            cache.set(cache_key, (pipe, None, None))
+            return self.compile(pipe, shared=False)
+        compiled = entry[2]
+        if compiled is not None and (not is_dict or entry[1] == pipe):
+            return compiled
+        compiled = self.compile(pipe)
+        cache.set(
+            cache_key, (pipe, deepcopy(pipe) if is_dict else None, compiled))
+        return compiled
 
     def check_match(self, obj, match_section, mode=Logic.AND):
         """
@@ -289,12 +1970,19 @@ class Pipe(Match, Alter, Converter):
         is to determine is object matches with conditions from match_section.
 
         match_section is a dictionary which keys are keys(attributes) of object.
+
+        Evaluation is lazy: with AND logic we stop at first key which does not
+        match, with OR logic - at first key which matches.
         """
-        matches = []
+        is_or = mode == Logic.OR
 
         for key, match_key_section in pyiteritems(match_section):
             # get object key(attribute) value.
-            object_value = self.get_object_value(obj, key)
+            path = self.key_path(key)
+            if path is not None:
+                object_value = path.get(obj)
+            else:
+                object_value = self.get_object_value(obj, key)
             # get logic operator for key conditions.
             condition_mode = match_key_section.get("mode", Logic.AND)
             # get list of conditions for key to check.
@@ -309,42 +1997,50 @@ class Pipe(Match, Alter, Converter):
                 conditions,
                 mode=condition_mode,
                 value_type=condition_value_type,
-                value_format=condition_value_format
+                value_format=condition_value_format,
+                cache=match_key_section.get("cache", False)
             )
-            matches.append(is_matched)
+            if is_matched == is_or:
+                return is_or
 
-        if mode == Logic.OR:
-            return any(matches)
-        else:
-            return all(matches)
+        return not is_or
 
-    def check_key(self, object_value, conditions, mode=Logic.AND, value_type=None, value_format=None):
+    def check_key(self, object_value, conditions, mode=Logic.AND, value_type=None, value_format=None, cache=False):
         """
         Here we determine if object value matches conditions.
         We also have logic operator for conditions, value_type and value_format
         that used to convert value from condition to necessary form to use with
-        condition operators.
+        condition operators. Set cache to True to convert object value using
+        conversion cache too.
         """
         if not isinstance(conditions, list):
             raise TypeError('conditions must be list')
 
-        matches = []
+        is_or = mode == Logic.OR
         # convert object value according to format
-        object_value = self.convert(object_value, value_type, value_format)
+        if cache:
+            object_value = self.convert_cached(
+                object_value, value_type, value_format)
+        else:
+            object_value = self.convert(object_value, value_type, value_format)
 
         for operator, condition_value in conditions:
             # convert condition value according to format
-            condition_value = self.convert(
-                condition_value, value_type, value_format)
+            prepare = getattr(self, "prepare_match_%s" % operator, None)
+            if prepare is not None:
+                condition_value = prepare(
+                    condition_value, value_type, value_format)
+            else:
+                condition_value = self.convert_cached(
+                    condition_value, value_type, value_format)
             # check if object value matches this condition
             is_matched = self.check_condition(
                 operator, object_value, condition_value)
-            matches.append(is_matched)
+            # stop as soon as result is known.
+            if bool(is_matched) == is_or:
+                return is_or
 
-        if mode == Logic.OR:
-            return any(matches)
-        else:
-            return all(matches)
+        return not is_or
 
     def check_condition(self, operator, object_value, condition_value):
         """
@@ -371,7 +2067,6 @@ class Pipe(Match, Alter, Converter):
         drop = alter_section.get("drop", None)
         if drop:
             obj = self.alter_delete(obj, drop)
-            del alter_section['drop']
         if obj:
             obj = self.apply_operators(obj, alter_section)
         return obj
@@ -382,6 +2077,9 @@ class Pipe(Match, Alter, Converter):
         keys(attributes) of object.
         """
         for operator, key_section in pyiteritems(section):
+            if operator == "drop":
+                # keys are deleted by alter_delete.
+                continue
             for key, alter_info in pyiteritems(key_section):
                 obj_value = self.get_object_value(obj, key)
                 new_value = self.alter_value(operator, obj_value, alter_info)
@@ -397,7 +2095,7 @@ class Pipe(Match, Alter, Converter):
         value = alter_info.get('value', None)
         value_type = alter_info.get('type', None)
         value_format = alter_info.get('format', None)
-        alter_value = self.convert(
+        alter_value = self.convert_cached(
             value,
             value_type,
             value_format    
@@ -428,6 +2126,12 @@ class ObjectPipe(Pipe):
         """
         return getattr(obj, key, None)
 
+    def copy_object(self, obj):
+        """
+        Return shallow copy of object.
+        """
+        return copy(obj)
+
     def del_object_key(self, obj, key):
         """
         Delete attribute.
@@ -0,0 +1,88 @@
+# coding: utf-8
+#
+# Copyright 2012 Alexandr Emelin
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import time
+
+
+# the most precise clock available.
+timer = getattr(time, "perf_counter", time.time)
+
+
+class Stats(object):
+    """
+    Counters of instrumented Pipe: per pipe (by pipe id), per operator
+    method and per conversion type. Every counter is a dictionary with
+    number of calls and cumulative time in seconds at least.
+    """
+    sections = ("pipes", "operators", "conversions")
+
+    def __init__(self):
+        self.pipes = {}
+        self.operators = {}
+        self.conversions = {}
+
+    def counter(self, section, name, *fields):
+        """
+        Return counter dictionary creating it with given extra fields.
+        """
+        counters = getattr(self, section)
+        counter = counters.get(name)
+        if counter is None:
+            counter = counters[name] = {"calls": 0, "time": 0.0}
+            for field in fields:
+                counter[field] = 0
+        return counter
+
+    def snapshot(self):
+        """
+        Return copy of all counters.
+        """
+        result = {}
+        for section in self.sections:
+            counters = getattr(self, section)
+            result[section] = dict(
+                (name, dict(counter)) for name, counter in counters.items())
+        return result
+
+    def reset(self):
+        """
+        Set all counters to zero.
+        """
+        for section in self.sections:
+            for counter in getattr(self, section).values():
+                for field in counter:
+                    counter[field] = 0.0 if field == "time" else 0
+
+
+class TimedCall(object):
+    """
+    Callable which calls function and updates counter with number of
+    calls and time spent. If count_matched is True number of true results
+    is counted too.
+    """
+    def __init__(self, function, counter, count_matched=False):
+        self.function = function
+        self.counter = counter
+        self.count_matched = count_matched
+
+    def __call__(self, *args, **kwargs):
+        started = timer()
+        result = self.function(*args, **kwargs)
+        counter = self.counter
+        counter["time"] += timer() - started
+        counter["calls"] += 1
+        if self.count_matched and result:
+            counter["matched"] += 1
+        return result
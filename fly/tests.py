@@ -1,11 +1,31 @@
 # coding: utf-8
+import gc
 import sys
 import os
+import pickle
+import shutil
+import tempfile
+import threading
+import linecache
+import traceback
 
 path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, path)
 
 from fly import Pipe, Logic, ObjectPipe, Match, Alter, Converter
+from fly.index import PipeIndex, PrefixTrie, Automaton
+from fly.parallel import ParallelPipe, chunked
+from fly.fanout import FanOut
+from fly.codegen import GeneratedPipe
+from fly import persist
+from fly.columnar import ColumnarPipe, to_columns, to_records
+from fly import columnar
+try:
+    import asyncio
+    from fly.aio import AsyncPipe, iterate, collect
+except (ImportError, SyntaxError):
+    AsyncPipe = None
+from unittest import skipIf
 from unittest import TestCase, main
 from copy import copy
 from datetime import datetime, date, time, timedelta
@@ -289,6 +309,814 @@ class PipeTest(TestCase):
         res = p.apply(copy(self.dictionary), pipe)
         self.assertEqual(res, None)
 
+    def test_compile(self):
+        pipe = {
+            "match": {
+                "hostname": {
+                    "conditions": [("endswith", ".ru")]
+                },
+                "repeats": {
+                    "conditions": [("gte", "50")],
+                    "type": "int"
+                }
+            },
+            "alter": {
+                "set": {
+                    "status": {
+                        "value": "2",
+                        "type": "int"
+                    }
+                }
+            }
+        }
+        p = Pipe()
+        compiled = p.compile(json.dumps(pipe))
+        self.assertTrue(p.compile(compiled) is compiled)
+        repeats = [key for key in compiled.keys if key.key == "repeats"][0]
+        # condition value converted once during compilation.
+        self.assertEqual(repeats.conditions[0][2], 50)
+        for _ in range(3):
+            res = p.apply(copy(self.dictionary), compiled)
+            self.assertEqual(res['status'], 2)
+        obj = copy(self.dictionary)
+        obj['hostname'] = 'mail.com'
+        self.assertEqual(compiled.apply(obj)['status'], 1)
+
+    def test_compile_validates_pipe(self):
+        p = Pipe()
+        pipe = {
+            "match": {
+                "hostname": {
+                    "conditions": [("unknown", "mail.ru")]
+                }
+            }
+        }
+        self.assertRaises(ValueError, p.compile, pipe)
+        pipe = {
+            "match": {
+                "hostname": {
+                    "conditions": ("exact", "mail.ru")
+                }
+            }
+        }
+        self.assertRaises(TypeError, p.compile, pipe)
+        pipe = {
+            "match": {
+                "hostname": {
+                    "conditions": [("exact", "mail.ru")]
+                }
+            },
+            "alter": {
+                "unknown": {}
+            }
+        }
+        self.assertRaises(ValueError, p.compile, pipe)
+
+    def test_process(self):
+        pipes = [
+            {
+                "priority": 1,
+                "match": {"status": {"conditions": [("exact", 2)]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            },
+            {
+                "priority": 0,
+                "match": {"status": {"conditions": [("exact", 1)]}},
+                "alter": {"set": {"status": {"value": 2}}}
+            }
+        ]
+        p = Pipe(pipes)
+        res = p.process(copy(self.dictionary))
+        self.assertEqual(res['status'], 2)
+        self.assertEqual(res['repeats'], 101)
+        # pipes are not consumed by process.
+        res = p.process(copy(self.dictionary))
+        self.assertEqual(res['repeats'], 101)
+
+    def test_process_many(self):
+        pipes = [
+            {
+                "match": {"status": {"conditions": [("exact", 1)]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            },
+            {
+                "match": {"hostname": {"conditions": [("exact", "ya.ru")]}},
+                "alter": {"drop": "ALL"}
+            }
+        ]
+        p = Pipe(pipes)
+        objects = []
+        for hostname in ("mail.ru", "ya.ru", "mail.ru"):
+            obj = copy(self.dictionary)
+            obj["hostname"] = hostname
+            objects.append(obj)
+
+        results = p.process_many(iter(objects + [None]))
+        self.assertFalse(isinstance(results, list))
+        results = list(results)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]["repeats"], 101)
+        self.assertEqual(results[1], None)
+        self.assertEqual(results[3], None)
+
+        results = list(p.process_many(objects, skip_none=True))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]["repeats"], 102)
+
+    def test_process_json(self):
+        pipes = [
+            {
+                "match": {"status": {"conditions": [("exact", 1)]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            },
+            {
+                "match": {"hostname": {"conditions": [("exact", "ya.ru")]}},
+                "alter": {"drop": "ALL"}
+            }
+        ]
+        p = Pipe(pipes)
+        data = json.dumps(self.dictionary).encode("utf-8")
+        res = p.process_json(data)
+        self.assertTrue(isinstance(res, bytes))
+        self.assertEqual(json.loads(res.decode("utf-8"))["repeats"], 101)
+
+        # nothing matched - the same buffer is returned.
+        obj = copy(self.dictionary)
+        obj["status"] = 0
+        data = json.dumps(obj, indent=2).encode("utf-8")
+        self.assertTrue(p.process_json(data) is data)
+        text = json.dumps(obj)
+        self.assertTrue(p.process_json(text) is text)
+
+        obj["hostname"] = "ya.ru"
+        self.assertEqual(p.process_json(json.dumps(obj)), None)
+        self.assertEqual(p.process_json(None), None)
+
+    def test_key_paths(self):
+        pipes = [
+            {
+                "match": {
+                    "user.profile.locale": {"conditions": [("exact", "ru")]},
+                    "meta.tags[0]": {"conditions": [("exact", "alert")]}
+                },
+                "alter": {
+                    "set": {"user.profile.lang": {"value": "russian"}},
+                    "append": {"meta.tags": {"value": "seen"}},
+                    "drop": ["user.secret"]
+                }
+            },
+            {
+                # sees value set by previous pipe.
+                "match": {"user.profile.lang": {"conditions": [("exact", "russian")]}},
+                "alter": {"incr": {"meta.count": {"value": 1}}}
+            }
+        ]
+        expected = {
+            "user": {"profile": {"locale": "ru", "lang": "russian"}},
+            "meta": {"tags": ["alert", "seen"], "count": 2}
+        }
+        for options in ({}, {"index": True}, {"codegen": True}):
+            p = Pipe(pipes, key_paths=True, copy_on_write=True, **options)
+            obj = {
+                "user": {"profile": {"locale": "ru"}, "secret": 1},
+                "meta": {"tags": ["alert"], "count": 1}
+            }
+            self.assertEqual(p.process(obj), expected)
+            # nested containers of original object are not changed.
+            self.assertEqual(obj["user"], {"profile": {"locale": "ru"}, "secret": 1})
+            self.assertEqual(obj["meta"]["tags"], ["alert"])
+            self.assertEqual(pickle.loads(pickle.dumps(p)).process(obj), expected)
+            self.assertEqual(p.process({"user": None, "meta": {"tags": []}}),
+                             {"user": None, "meta": {"tags": []}})
+
+        # missing containers are created.
+        p = Pipe(key_paths=True)
+        res = p.apply({}, {
+            "match": {"x": {"conditions": [("exact", None)]}},
+            "alter": {"set": {"a.b.c": {"value": 1}}}
+        })
+        self.assertEqual(res, {"a": {"b": {"c": 1}}})
+        # paths which can not be set are skipped, object is not changed.
+        pipe = {
+            "match": {"status": {"conditions": [("exact", 1)]}},
+            "alter": {"set": {
+                "meta.tags[0]": {"value": "alert"},
+                "user.name": {"value": "root"},
+                "tags[5]": {"value": "late"},
+                "status": {"value": 2}
+            }}
+        }
+        for options in ({}, {"copy_on_write": True}, {"codegen": True}):
+            p = Pipe([pipe], key_paths=True, **options)
+            obj = {"status": 1, "user": "guest", "tags": ["a"]}
+            self.assertEqual(p.process(obj), {"status": 2, "user": "guest", "tags": ["a"]})
+            self.assertEqual(p.process({"status": 1, "meta": {}, "user": {}}),
+                             {"status": 2, "meta": {}, "user": {"name": "root"}})
+        # keys with dots are top level keys by default.
+        self.assertEqual(Pipe().key_path("a.b"), None)
+        self.assertEqual(p.key_path("a.b").steps, ("a", "b"))
+        self.assertEqual(p.key_path("a[0][-1].b").steps, ("a", 0, -1, "b"))
+        self.assertRaises(ValueError, p.key_path, "a..b")
+        self.assertRaises(ValueError, p.key_path, "a[x]")
+
+    def test_result_cache(self):
+        pipes = [
+            {
+                "id": "repeats",
+                "match": {"informer": {"conditions": [("exact", "MAILDAEMON")]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            },
+            {
+                "id": "sms",
+                "match": {"repeats": {"conditions": [("gt", 100)]}},
+                "alter": {"set": {"sms": {"value": False}}}
+            }
+        ]
+        for options in ({}, {"index": True}):
+            p = Pipe(pipes, result_cache_size=2, **options)
+            plain = Pipe(pipes, **options)
+            for repeats in (100, 100, 100, 50, 100):
+                obj = copy(self.dictionary)
+                obj["repeats"] = repeats
+                self.assertEqual(p.process(copy(obj)), plain.process(copy(obj)))
+            stats = p.result_cache.stats()
+            self.assertEqual(stats["hits"], 3)
+            self.assertEqual(stats["misses"], 2)
+            # resource is not read by pipes, so it is not a part of key.
+            obj = copy(self.dictionary)
+            obj["resource"] = "http://ya.ru"
+            self.assertEqual(p.process(obj)["repeats"], 101)
+            self.assertEqual(p.result_cache.stats()["hits"], 4)
+
+            # unhashable values are not cached.
+            obj = copy(self.dictionary)
+            obj["informer"] = ["MAILDAEMON"]
+            self.assertEqual(p.process(obj)["repeats"], 100)
+            self.assertEqual(p.result_cache.stats()["size"], 2)
+
+            # changed pipes invalidate results.
+            p.remove_pipe("repeats")
+            self.assertEqual(len(p.result_cache), 0)
+            self.assertEqual(p.process(copy(self.dictionary))["repeats"], 100)
+
+            list(p.process_many([copy(self.dictionary)] * 3))
+            self.assertEqual(p.result_cache.stats()["evictions"], 0)
+            self.assertEqual(p.result_cache.stats()["hits"], 7)
+
+    def test_result_cache_with_key_paths(self):
+        pipes = [
+            {
+                "match": {"user.profile.locale": {"conditions": [("ne", 1)]}},
+                "alter": {"set": {"user.name": {"value": "bob"}}}
+            },
+            {
+                "match": {"user.name": {"conditions": [("exact", "bob")]}},
+                "alter": {"set": {"text": {"value": "hit"}}}
+            }
+        ]
+        for options in ({}, {"index": True}, {"codegen": True}):
+            p = Pipe(pipes, key_paths=True, result_cache_size=4, **options)
+            plain = Pipe(pipes, key_paths=True, **options)
+            for obj in ({"user": {}}, {"user": "plain"}, {"user": {}}):
+                self.assertEqual(p.process(copy(obj)), plain.process(copy(obj)))
+            self.assertEqual(p.process({"user": "plain"}), {"user": "plain"})
+            # results of pipes which alter key paths are not cached.
+            self.assertEqual(len(p.result_cache), 0)
+
+    def test_between(self):
+        night = {
+            "created": {
+                "conditions": [("between", ["21:00:00", "09:00:00"])],
+                "type": "time",
+                "format": "%H:%M:%S"
+            }
+        }
+        day = {
+            "created": {
+                "conditions": [("not_between", ["21:00:00", "09:00:00"])],
+                "type": "time"
+            }
+        }
+        # 2023-11-14 22:13:20 UTC
+        epoch = 1700000000
+        for codegen in (False, True):
+            p = Pipe(codegen=codegen)
+            for section, value, expected in (
+                    (night, "23:00:00", True),
+                    (night, "09:00:00", True),
+                    (night, "12:00:00", False),
+                    (night, datetime(2012, 1, 1, 3), True),
+                    (night, epoch, True),
+                    (night, epoch + 12 * 3600, False),
+                    (day, "12:00:00", True),
+                    (day, epoch, False)):
+                pipe = p.compile({"match": section})
+                self.assertEqual(pipe.match({"created": value}), expected)
+                self.assertEqual(p.check_match({"created": value}, section), expected)
+            pipe = p.compile({"match": night})
+            self.assertEqual(pipe.to_dict()["match"]["created"]["conditions"],
+                             [["between", ["21:00:00", "09:00:00"]]])
+
+        p = Pipe()
+        section = {
+            "created": {
+                "conditions": [("between", ["2023-11-14 00:00", "2023-11-15 00:00"])],
+                "type": "datetime"
+            }
+        }
+        self.assertTrue(p.check_match({"created": epoch}, section))
+        self.assertTrue(p.check_match({"created": datetime(2023, 11, 14, 1)}, section))
+        self.assertFalse(p.check_match({"created": epoch + 86400}, section))
+        section = {
+            "day": {
+                "conditions": [("between", ["2023-11-01", "2023-11-14"])],
+                "type": "date"
+            }
+        }
+        self.assertTrue(p.check_match({"day": epoch}, section))
+        self.assertFalse(p.check_match({"day": epoch + 86400}, section))
+
+    def test_reversed_between(self):
+        p = Pipe()
+        for condition_value, value_type in (
+                ([10, 1], None),
+                (["2023-11-15 00:00", "2023-11-14 00:00"], "datetime"),
+                (["2023-11-14", "2023-11-01"], "date")):
+            pipe = {"match": {"value": {"conditions": [("between", condition_value)], "type": value_type}}}
+            self.assertRaises(ValueError, p.compile, pipe)
+            self.assertRaises(ValueError, p.check_match, {"value": 5}, pipe["match"])
+        self.assertTrue(p.check_match({"value": 5}, {"value": {"conditions": [("between", [5, 5])]}}))
+        self.assertTrue(p.compile({"match": {"value": {"conditions": [("between", ["21:00:00", "09:00:00"])], "type": "time"}}}).keys[0].conditions[0][2].wrap)
+        section = {"level": {"conditions": [("between", [1, 3])]}}
+        self.assertTrue(p.check_match({"level": 3}, section))
+        self.assertFalse(p.check_match({"level": 4}, section))
+        self.assertRaises(ValueError, p.compile, {
+            "match": {"level": {"conditions": [("between", [1])]}}})
+
+    def test_set_operators(self):
+        pipes = [
+            {
+                "match": {"informer": {"conditions": [("in", ["MAILDAEMON", "CRON"])]}},
+                "alter": {"set": {"known": {"value": True}}}
+            },
+            {
+                "match": {"status": {"conditions": [("not_in", ["1", "2"])], "type": "int"}},
+                "alter": {"drop": "ALL"}
+            },
+            {
+                "match": {"tags": {"conditions": [("contains_any", ["alert", "page"])]}},
+                "alter": {"set": {"sms": {"value": False}}}
+            },
+            {
+                "match": {"tags": {"conditions": [("contains_all", ["http", "alert"])]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            }
+        ]
+        plain = Pipe(pipes)
+        for options in ({}, {"index": True}, {"codegen": True}):
+            p = Pipe(pipes, **options)
+            res = p.process(copy(self.dictionary))
+            self.assertEqual(res["known"], True)
+            self.assertEqual(res["sms"], False)
+            self.assertEqual(res["repeats"], 101)
+            for informer, status, tags in (
+                    ("CRON", "2", ["page"]),
+                    ("MAILDAEMON", 3, None),
+                    (["MAILDAEMON"], 1, [["alert"], "http"]),
+                    ("OTHER", 1, 5),
+                    ("OTHER", 1, "alert")):
+                obj = copy(self.dictionary)
+                obj.update(informer=informer, status=status, tags=tags)
+                self.assertEqual(p.process(copy(obj)), plain.process(copy(obj)))
+        obj = copy(self.dictionary)
+        obj.update(informer=["MAILDAEMON"], tags=[["alert"], "http"])
+        res = plain.process(obj)
+        self.assertFalse("known" in res)
+        self.assertEqual(res["repeats"], 100)
+
+        pipe = plain.compile(pipes[1])
+        self.assertEqual(pipe.keys[0].conditions[0][2], frozenset([1, 2]))
+        self.assertEqual(pipe.to_dict()["match"]["status"]["conditions"],
+                         [["not_in", ["1", "2"]]])
+        self.assertTrue(plain.check_match(
+            {"tags": ["page"]}, {"tags": {"conditions": [("contains_any", ["page"])]}}))
+        self.assertRaises(ValueError, plain.compile, {
+            "match": {"informer": {"conditions": [("in", "MAILDAEMON")]}}})
+        # values which are not lists have no values.
+        for operator, expected in (("contains_any", False), ("contains_all", False)):
+            self.assertEqual(plain.check_match(
+                {"tags": 5}, {"tags": {"conditions": [(operator, ["page"])]}}), expected)
+        self.assertTrue(plain.make_match_contains_all(5, frozenset()))
+        self.assertFalse(plain.make_match_contains_any(5.5, frozenset([5.5])))
+
+    def test_conversion_cache(self):
+        p = Pipe(conversion_cache_size=2)
+        pipe = {
+            "match": {
+                "created": {
+                    "conditions": [("gte", "21:00:00")],
+                    "type": "time",
+                    "format": "%H:%M:%S",
+                    "cache": True
+                }
+            },
+            "alter": {
+                "drop": "ALL"
+            }
+        }
+        compiled = p.compile(pipe)
+        self.assertEqual(p.conversion_cache.stats()['misses'], 1)
+        self.assertEqual(compiled.apply({"created": "22:00:00"}), None)
+        self.assertEqual(compiled.apply({"created": "22:00:00"}), None)
+        stats = p.conversion_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+        self.assertEqual(p.convert_cached(1, "str", None), "1")
+        self.assertEqual(p.convert_cached(True, "str", None), "True")
+        self.assertEqual(p.conversion_cache.stats()['evictions'], 2)
+        # unhashable values are just converted.
+        self.assertEqual(p.convert_cached([1], "bool", None), True)
+
+        p = Pipe(conversion_cache_size=0)
+        self.assertEqual(p.conversion_cache, None)
+        self.assertEqual(p.convert_cached("1", "int", None), 1)
+
+    def test_check_match_short_circuit(self):
+        calls = []
+
+        class CountingPipe(Pipe):
+            def get_object_value(self, obj, key):
+                calls.append(key)
+                return Pipe.get_object_value(self, obj, key)
+
+        p = CountingPipe()
+        section = {
+            "hostname": {
+                "conditions": [("exact", "bail.ru"), ("unknown", "x")]
+            }
+        }
+        # unknown operator is never reached because first condition fails.
+        self.assertFalse(p.check_match(copy(self.dictionary), section))
+        self.assertTrue(
+            p.check_key("mail.ru", [("exact", "mail.ru"), ("unknown", "x")],
+                        mode=Logic.OR)
+        )
+
+        section = {
+            "hostname": {"conditions": [("exact", "bail.ru")]},
+            "protocol": {"conditions": [("exact", "http")]},
+        }
+        del calls[:]
+        self.assertFalse(p.check_match(copy(self.dictionary), section))
+        self.assertEqual(len(calls), 1)
+        del calls[:]
+        self.assertTrue(
+            p.check_match(copy(self.dictionary), section, mode=Logic.OR))
+        self.assertTrue(len(calls) in (1, 2))
+
+    def test_compile_reorder(self):
+        pipe = {
+            "match": {
+                "created": {
+                    "conditions": [("gte", "21:00:00")],
+                    "type": "time"
+                },
+                "hostname": {
+                    "mode": "or",
+                    "conditions": [("regex", "^mail"), ("exact", "mail.ru")]
+                }
+            }
+        }
+        compiled = Pipe(reorder=True).compile(pipe)
+        self.assertEqual(
+            [key.key for key in compiled.keys], ["hostname", "created"])
+        self.assertEqual(
+            [c[0] for c in compiled.keys[0].conditions], ["exact", "regex"])
+
+        obj = copy(self.dictionary)
+        obj["created"] = "22:00:00"
+        self.assertTrue(compiled.match(obj))
+        obj["hostname"] = "yandex.ru"
+        self.assertFalse(compiled.match(obj))
+
+    def test_instrumentation(self):
+        pipes = [
+            {
+                "id": "late",
+                "match": {
+                    "created": {"conditions": [("gte", "21:00:00")], "type": "time"},
+                    "text": {"conditions": [("icontains", "github")]}
+                },
+                "alter": {"drop": "ALL"}
+            },
+            {
+                "match": {"text": {"conditions": [("contains", "fork")]}},
+                "alter": {"set": {"forked": {"value": True}}}
+            }
+        ]
+        p = Pipe(pipes, instrument=True)
+        p.process({"created": "22:00:00", "text": "Github"})
+        p.process({"created": "10:00:00", "text": "fork me"})
+        stats = p.stats.snapshot()
+        self.assertEqual(
+            sorted(stats.keys()), ["conversions", "operators", "pipes"])
+        late = stats["pipes"]["late"]
+        self.assertEqual(
+            (late["calls"], late["matched"], late["not_matched"], late["dropped"]),
+            (2, 1, 1, 1)
+        )
+        self.assertTrue(late["time"] > 0)
+        # pipe without id is identified by hash of its specification.
+        self.assertEqual(len(stats["pipes"]), 2)
+        self.assertEqual(stats["operators"]["make_match_contains"]["matched"], 1)
+        self.assertEqual(stats["operators"]["make_match_icontains"]["calls"], 1)
+        self.assertEqual(stats["operators"]["make_alter_set"]["calls"], 1)
+        self.assertEqual(stats["conversions"]["time"]["calls"], 2)
+
+        p.stats.reset()
+        self.assertEqual(p.stats.snapshot()["pipes"]["late"]["calls"], 0)
+
+        p = Pipe(pipes)
+        self.assertEqual(p.stats, None)
+        self.assertEqual(type(p.pipes[0].keys[0].conditions[0][1]).__name__, "method")
+
+    def test_copy_on_write(self):
+        pipe = {
+            "match": {"hostname": {"conditions": [("exact", "mail.ru")]}},
+            "alter": {
+                "drop": ["informer"],
+                "append": {"tags": {"value": "mail"}},
+                "set": {"status": {"value": 2}}
+            }
+        }
+        original = copy(self.dictionary)
+        tags = original["tags"]
+        p = Pipe(copy_on_write=True)
+        compiled = p.compile(pipe)
+        for _ in range(2):
+            res = p.apply(original, compiled)
+            self.assertEqual(res["tags"], ["http", "alert", "mail"])
+            self.assertEqual(res["status"], 2)
+            self.assertFalse("informer" in res)
+        # original object and its lists are untouched.
+        self.assertEqual(original, self.dictionary)
+        self.assertEqual(tags, ["http", "alert"])
+        # not altered values are shared.
+        self.assertTrue(res["resource"] is original["resource"])
+
+        res = Pipe([pipe], copy_on_write=True, index=True).process(original)
+        self.assertEqual(res["status"], 2)
+        self.assertEqual(original["status"], 1)
+
+        pipe["alter"] = {"drop": "ALL"}
+        self.assertEqual(p.apply(original, pipe), None)
+        self.assertEqual(original, self.dictionary)
+
+    def test_codegen(self):
+        pipes = [
+            {
+                "priority": 1,
+                "match": {
+                    "hostname": {"mode": "or", "conditions": [("endswith", ".com"), ("iendswith", ".RU")]},
+                    "informer": {"conditions": [("regex", "^MAIL"), ("icontains", "daemon")]}
+                },
+                "alter": {
+                    "drop": ["sms"],
+                    "set": {"status": {"value": "2", "type": "int"}},
+                    "incr": {"repeats": {"value": 1}},
+                    "append": {"tags": {"value": "mail"}}
+                }
+            },
+            {
+                "priority": 2,
+                "mode": "or",
+                "match": {
+                    "status": {"conditions": [("gt", 5)]},
+                    "repeats": {"conditions": [("exact", "101")], "type": "str"}
+                },
+                "alter": {"replace": {"protocol": {"value": "http", "replacement": "https"}}}
+            },
+            {
+                "priority": 3,
+                "match": {"status": {"conditions": [("exact", 2)]}},
+                "alter": {"drop": "ALL"}
+            }
+        ]
+        p = Pipe(pipes, codegen=True, copy_on_write=True)
+        self.assertTrue(all(isinstance(pipe, GeneratedPipe) for pipe in p.pipes))
+        self.assertTrue("obj.get('hostname')" in p.pipes[0].source)
+        self.assertTrue("obj['status'] = 2" in p.pipes[0].source)
+        compiled = Pipe(pipes[:2], copy_on_write=True)
+        for hostname in ("mail.ru", "mail.org", "example.com"):
+            obj = copy(self.dictionary)
+            obj["hostname"] = hostname
+            self.assertEqual(p.apply(obj, pipes[0]), compiled.apply(obj, pipes[0]))
+            self.assertEqual(Pipe(pipes[:2], codegen=True, copy_on_write=True).process(obj),
+                             compiled.process(obj))
+            self.assertEqual(obj["tags"], ["http", "alert"])
+        self.assertEqual(p.process(copy(self.dictionary)), None)
+
+        # equal specifications share generated code.
+        hits = p.code_cache.stats()["hits"]
+        p.compile(pipes[0])
+        self.assertEqual(p.code_cache.stats()["hits"], hits + 1)
+        # overriden operators are called, not inlined.
+        class CustomPipe(Pipe):
+            def make_match_exact(self, obj_value, condition_value):
+                return obj_value == condition_value
+        source = CustomPipe(codegen=True).compile(pipes[2]).source
+        self.assertFalse("== 2" in source)
+
+        p = pickle.loads(pickle.dumps(p))
+        self.assertEqual(p.process(copy(self.dictionary)), None)
+
+    def test_generated_source(self):
+        p = Pipe(codegen=True)
+        cached = len(linecache.cache)
+        for status in range(100):
+            pipe = {"match": {"status": {"conditions": [("gt", status)]}}}
+            p.compile(pipe)
+            # pipes applied once are not generated.
+            self.assertFalse(isinstance(p.compile_once(dict(pipe)), GeneratedPipe))
+        self.assertEqual(len(linecache.cache), cached)
+        compiled = p.compile({"match": {"status": {"conditions": [("gt", 1)]}}})
+        try:
+            compiled.match({"status": "2"})
+        except TypeError:
+            lines = traceback.format_exc()
+        self.assertTrue("(value > 1)" in lines)
+
+    def test_compact_pipes(self):
+        spec = {
+            "id": "night",
+            "priority": 2,
+            "mode": "or",
+            "match": {
+                "created": {"mode": "or", "type": "time", "conditions": [["lte", "09:00:00"], ["gte", "21:00:00"]]},
+                "hostname": {"mode": "and", "conditions": [["iendswith", ".RU"], ["exact", "mail.ru"]]}
+            },
+            "alter": {"drop": ["sms"], "set": {"status": {"value": "2", "type": "int"}}}
+        }
+        p = Pipe([json.dumps(spec), json.dumps(dict(spec, id="day"))])
+        night, day = p.pipes
+        self.assertFalse(hasattr(night, "__dict__"))
+        self.assertFalse(hasattr(night.keys[0], "__dict__"))
+        self.assertEqual(night.to_dict(), spec)
+        self.assertEqual(night.spec, spec)
+        # equal keys, values and alter infos are shared between pipes.
+        self.assertTrue(night.keys[0].key is day.keys[0].key)
+        self.assertTrue(night.alters[0][4] is day.alters[0][4])
+        self.assertTrue(night.altered_keys is day.altered_keys)
+        self.assertTrue(night.keys[0].conditions[0][1] is day.keys[0].conditions[0][1])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            restored = pickle.loads(pickle.dumps(p, protocol))
+            self.assertEqual(restored.pipes[0].to_dict(), spec)
+            obj = dict(self.dictionary, created="22:00:00")
+            self.assertEqual(restored.process(obj)["status"], 2)
+
+    def test_alter_does_not_modify_pipe(self):
+        pipe = {
+            "match": {"hostname": {"conditions": [("exact", "mail.ru")]}},
+            "alter": {
+                "drop": ["informer"],
+                "set": {"status": {"value": 2}}
+            }
+        }
+        p = Pipe()
+        res = p.alter(copy(self.dictionary), pipe)
+        self.assertFalse("informer" in res)
+        self.assertEqual(res["status"], 2)
+        self.assertEqual(pipe["alter"]["drop"], ["informer"])
+
+    def test_pipes_do_not_share_specification(self):
+        spec = {
+            "id": 1,
+            "match": {"status": {"conditions": [("exact", 1)]}},
+            "alter": {
+                "replace": {"message": {"value": "error", "replacement": "warning"}},
+                "drop": ["informer"]
+            }
+        }
+        other = {
+            "id": 2,
+            "match": {"status": {"conditions": [("exact", 1)]}},
+            "alter": {
+                "replace": {"message": {"value": "error", "replacement": "warning"}},
+                "drop": ["informer"]
+            }
+        }
+        p = Pipe([spec, other])
+        spec["alter"]["replace"]["message"]["replacement"] = "X"
+        spec["alter"]["drop"].append("hostname")
+        exported = p.get_pipe(1).to_dict()
+        exported["alter"]["replace"]["message"]["replacement"] = "Y"
+        exported["alter"]["drop"].append("status")
+        obj = {"status": 1, "message": "error", "informer": "a", "hostname": "h"}
+        self.assertEqual(p.process(obj), {"status": 1, "message": "warning", "hostname": "h"})
+        self.assertEqual(p.get_pipe(2).to_dict()["alter"]["replace"]["message"]["replacement"], "warning")
+
+    def test_apply_cache(self):
+        p = Pipe()
+        pipe = {
+            "match": {"status": {"conditions": [("exact", 1)]}},
+            "alter": {"set": {"message": {"value": "one"}}}
+        }
+        first = p.compile_once(pipe)
+        self.assertTrue(p.compile_once(pipe) is not first)
+        compiled = p.compile_once(pipe)
+        self.assertTrue(p.compile_once(pipe) is compiled)
+        self.assertEqual(p.apply({"status": 1}, pipe), {"status": 1, "message": "one"})
+        # changed specification is compiled again.
+        pipe["alter"]["set"]["message"]["value"] = "two"
+        self.assertEqual(p.apply({"status": 1}, pipe), {"status": 1, "message": "two"})
+        self.assertEqual(p.apply({"status": 1}, json.dumps(pipe)), {"status": 1, "message": "two"})
+        self.assertTrue(p.compile_once(json.dumps(pipe)) is p.compile_once(json.dumps(pipe)))
+        self.assertTrue(Pipe(apply_cache_size=0).apply_cache is None)
+
+    def test_intern_tables_do_not_grow(self):
+        p = Pipe()
+        for i in range(100):
+            pipe = {
+                "id": i,
+                "match": {"meta.status": {"conditions": [("exact", i)]}},
+                "alter": {"set": {"message": {"value": "message %d" % i}}}
+            }
+            p.apply({"meta": {"status": i}}, pipe)
+            p.add_pipe(pipe)
+        for i in range(100):
+            p.remove_pipe(i)
+        gc.collect()
+        self.assertTrue(len(p.interned) < 10)
+        self.assertEqual(len(p.paths), 0)
+        self.assertEqual(len(p.alter_infos), 0)
+
+    def test_conversion_memo(self):
+        conversions = []
+
+        class CountingPipe(Pipe):
+            def convert(self, value, value_type, value_format):
+                conversions.append(value)
+                return Pipe.convert(self, value, value_type, value_format)
+
+        pipes = []
+        for hour in range(10):
+            pipes.append({
+                "match": {
+                    "created": {"conditions": [("gte", "%02d:00:00" % hour)], "type": "time"}
+                },
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            })
+        pipes.append({
+            "match": {
+                "repeats": {"conditions": [("gte", "110")], "type": "int"}
+            },
+            "alter": {"set": {"status": {"value": 2}}}
+        })
+        for index in (False, True):
+            p = CountingPipe(pipes, conversion_cache_size=0, index=index)
+            del conversions[:]
+            obj = copy(self.dictionary)
+            obj["created"] = "21:40:39"
+            res = p.process(obj)
+            self.assertEqual(res["repeats"], 110)
+            self.assertEqual(res["status"], 2)
+            # object value of created converted once for all pipes.
+            self.assertEqual(conversions.count("21:40:39"), 1)
+
+    def test_regex_cache(self):
+        p = Pipe(regex_cache_size=2)
+        pipe = {
+            "match": {
+                "informer": {
+                    "mode": "or",
+                    "conditions": [
+                        ("regex", "^mail"),
+                        ("regex", {"pattern": "DAEMON", "method": "search"}),
+                    ]
+                }
+            }
+        }
+        compiled = p.compile(pipe)
+        self.assertTrue(compiled.match(copy(self.dictionary)))
+        self.assertEqual(p.regex_cache.stats()['size'], 2)
+        # the same patterns are taken from cache.
+        p.compile(pipe)
+        self.assertEqual(p.regex_cache.stats()['hits'], 2)
+
+        self.assertTrue(p.make_match_regex(
+            "MAILDAEMON", {"pattern": "mail", "flags": "i"}))
+        self.assertFalse(p.make_match_regex(
+            "MAILDAEMON", {"pattern": "mail", "method": "fullmatch", "flags": "i"}))
+        self.assertTrue(p.make_match_regex(
+            "MAILDAEMON", {"pattern": "mail.*", "method": "fullmatch", "flags": "i"}))
+        self.assertEqual(p.regex_cache.stats()['evictions'], 3)
+        self.assertRaises(
+            ValueError, p.compile_regex, {"pattern": "a", "method": "find"})
+        self.assertRaises(
+            ValueError, p.compile_regex, {"pattern": "a", "flags": "z"})
+
 
 class ObjectPipeTest(TestCase):
 
@@ -322,6 +1150,48 @@ class ObjectPipeTest(TestCase):
         res = p.check_match(copy(self.obj), section)
         self.assertEqual(res, False)
 
+    def test_copy_on_write(self):
+        p = ObjectPipe(copy_on_write=True)
+        pipe = {
+            "match": {"hostname": {"conditions": [("exact", "mail.ru")]}},
+            "alter": {"set": {"status": {"value": 2}}}
+        }
+        res = p.apply(self.obj, pipe)
+        self.assertEqual(res.status, 2)
+        self.assertEqual(self.obj.status, 1)
+        self.assertTrue(res.resource is self.obj.resource)
+
+    def test_codegen(self):
+        p = ObjectPipe(codegen=True)
+        pipe = p.compile({
+            "match": {"hostname": {"conditions": [("exact", "mail.ru")]}},
+            "alter": {"set": {"status": {"value": 2}}, "drop": ["resource"]}
+        })
+        self.assertTrue("getattr(obj, 'hostname', None)" in pipe.source)
+        res = p.apply(copy(self.obj), pipe)
+        self.assertEqual(res.status, 2)
+        self.assertFalse(hasattr(res, "resource"))
+
+    def test_key_paths(self):
+        self.obj.owner = copy(self.obj)
+        self.obj.owner.hostname = "ya.ru"
+        self.obj.meta = {"tags": ["http"]}
+        pipe = {
+            "match": {
+                "owner.hostname": {"conditions": [("exact", "ya.ru")]},
+                "meta.tags[0]": {"conditions": [("exact", "http")]}
+            },
+            "alter": {"set": {"owner.status": {"value": 2},
+                              "meta.level": {"value": 3}}}
+        }
+        for codegen in (False, True):
+            p = ObjectPipe(key_paths=True, copy_on_write=True, codegen=codegen)
+            res = p.apply(self.obj, pipe)
+            self.assertEqual(res.owner.status, 2)
+            self.assertEqual(res.meta, {"tags": ["http"], "level": 3})
+            self.assertEqual(self.obj.owner.status, 1)
+            self.assertEqual(self.obj.meta, {"tags": ["http"]})
+
     def test_alter_delete(self):
         p = ObjectPipe()
         section = "all"
@@ -333,5 +1203,680 @@ class ObjectPipeTest(TestCase):
         self.assertFalse(hasattr(res, 'status'))
 
 
+class PipeIndexTest(TestCase):
+
+    def setUp(self):
+        self.pipes = []
+        for i in range(100):
+            self.pipes.append({
+                "match": {
+                    "username": {"conditions": [("exact", "user%d" % i)]},
+                    "text": {"conditions": [("icontains", "github")]}
+                },
+                "alter": {
+                    "replace": {"text": {"value": "Github", "replacement": "user%d" % i}}
+                }
+            })
+        self.pipes.append({
+            "match": {
+                "text": {"mode": "or", "conditions": [("startswith", "fork"), ("exact", "hi")]}
+            },
+            "alter": {"set": {"forked": {"value": True}}}
+        })
+        self.pipes.append({
+            "match": {
+                "created": {"conditions": [("gte", "21:00:00")], "type": "time"}
+            },
+            "alter": {"set": {"late": {"value": True}}}
+        })
+        self.pipes.append({
+            "priority": -1,
+            "match": {
+                "level": {"conditions": [("exact", 3)], "type": "int"}
+            },
+            "alter": {"set": {"username": {"value": "user7"}}}
+        })
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie()
+        trie.add("", 0)
+        trie.add("fo", 1)
+        trie.add("fork", 2)
+        trie.add("fx", 3)
+        self.assertEqual(trie.find("forked"), [0, 1, 2])
+        self.assertEqual(trie.find("f"), [0])
+
+    def test_automaton(self):
+        automaton = Automaton()
+        for pattern in ("he", "she", "his", "hers"):
+            automaton.add(pattern)
+        self.assertEqual(automaton.find("ushers"), set(["he", "she", "hers"]))
+        automaton.add("us")
+        self.assertEqual(automaton.find("ushers"), set(["us", "he", "she", "hers"]))
+        self.assertEqual(automaton.find("xyz"), set())
+
+    def test_substring_groups(self):
+        pipes = []
+        for word in ("github", "bitbucket", "gitlab"):
+            pipes.append({
+                "match": {"text": {"conditions": [("icontains", word)]}},
+                "alter": {"append": {"tags": {"value": word}}}
+            })
+        pipes.append({
+            "match": {
+                "text": {"mode": "or", "conditions": [("contains", "fork"), ("iexact", "HI")]}
+            },
+            "alter": {"append": {"tags": {"value": "fork"}}}
+        })
+        p = Pipe(pipes, index=True)
+        self.assertEqual(p.index.unindexed, [])
+        message = {"text": "Fork me on GitHub and GitLab", "tags": []}
+        memo = {}
+        candidates = p.index.candidates(message, memo)
+        self.assertEqual(len(candidates), 2)
+        # text is lowercased once and shared by all case insensitive checks.
+        self.assertEqual(memo[("text", "lower", None, None)], message["text"].lower())
+        res = p.process(message)
+        self.assertEqual(res["tags"], ["github", "gitlab"])
+        res = p.process({"text": "please fork", "tags": []})
+        self.assertEqual(res["tags"], ["fork"])
+        res = p.process({"text": "Hi", "tags": []})
+        self.assertEqual(res["tags"], ["fork"])
+
+    def test_lowercase_shared_in_memo(self):
+        for codegen in (False, True):
+            p = Pipe(codegen=codegen)
+            compiled = p.compile({
+                "match": {
+                    "text": {"conditions": [("istartswith", "FORK"), ("icontains", "GITHUB")]}
+                }
+            })
+            self.assertEqual(compiled.keys[0].conditions[0][2], "fork")
+            memo = {}
+            self.assertTrue(compiled.match({"text": "Fork me on Github"}, memo))
+            self.assertEqual(memo, {("text", "lower", None, None): "fork me on github"})
+            # memo is used instead of object value.
+            self.assertTrue(compiled.match({"text": "something else"}, memo))
+            self.assertFalse(compiled.match({"text": "something else"}))
+            # substrings found for all pipes at once are used too.
+            found_key = compiled.keys[0].conditions[1][4]
+            memo[found_key] = (frozenset(["github"]), frozenset())
+            self.assertFalse(compiled.match({"text": "fork me on github"}, memo))
+
+    def test_overriden_case_insensitive_operators(self):
+        class StrippingPipe(Pipe):
+            def make_match_iexact(self, obj_value, condition_value):
+                return obj_value.strip().lower() == condition_value.strip().lower()
+
+        class WordPipe(Pipe):
+            def make_match_contains(self, obj_value, condition_value):
+                return condition_value in obj_value.split()
+
+        alter = {"set": {"matched": {"value": True}}}
+        iexact = {"match": {"text": {"conditions": [("iexact", " Fork ")]}}, "alter": alter}
+        icontains = {"match": {"text": {"conditions": [("icontains", "FORK")]}}, "alter": alter}
+        for options in ({}, {"index": True}, {"codegen": True}):
+            p = StrippingPipe([iexact], **options)
+            self.assertFalse(p.pipes[0].keys[0].conditions[0][3])
+            self.assertTrue(p.process({"text": "FORK"})["matched"])
+            # overriden contains is not used by icontains.
+            p = WordPipe([icontains], **options)
+            self.assertTrue(p.process({"text": "forked"})["matched"])
+            p = Pipe([icontains], **options)
+            self.assertTrue(p.pipes[0].keys[0].conditions[0][3])
+            self.assertTrue(p.process({"text": "Forked"})["matched"])
+
+    def test_empty_object(self):
+        set_user = {
+            "match": {"user": {"conditions": [("exact", None)]}},
+            "alter": {"set": {"user": {"value": 1}}}
+        }
+        other = {
+            "priority": -1,
+            "match": {"status": {"conditions": [("exact", 1)]}},
+            "alter": {"set": {"status": {"value": 2}}}
+        }
+        for pipes in ([], [set_user], [other, set_user]):
+            plain = Pipe(pipes)
+            indexed = Pipe(pipes, index=True)
+            expected = plain.process({})
+            self.assertEqual(indexed.process({}), expected)
+            self.assertEqual(list(indexed.process_many([{}])), [expected])
+            self.assertEqual(indexed.process_json("{}"), plain.process_json("{}"))
+        self.assertEqual(Pipe([set_user], index=True).process({}), {"user": 1})
+
+    def test_overriden_operators_are_not_indexed(self):
+        class CaseInsensitivePipe(Pipe):
+            def make_match_exact(self, obj_value, condition_value):
+                return obj_value.lower() == condition_value.lower()
+
+            def make_match_startswith(self, obj_value, condition_value):
+                return obj_value.lower().startswith(condition_value.lower())
+
+        pipes = [
+            {"match": {"hostname": {"conditions": [("exact", "mail.ru")]}},
+             "alter": {"set": {"exact": {"value": True}}}},
+            {"match": {"hostname": {"conditions": [("startswith", "mail")]}},
+             "alter": {"set": {"prefix": {"value": True}}}},
+            {"match": {"hostname": {"conditions": [("contains", "ru")]}},
+             "alter": {"set": {"contains": {"value": True}}}}
+        ]
+        p = CaseInsensitivePipe(pipes, index=True)
+        self.assertEqual(len(p.index.unindexed), 2)
+        res = p.process({"hostname": "MAIL.RU"})
+        self.assertTrue(res["exact"])
+        self.assertTrue(res["prefix"])
+        self.assertFalse("contains" in res)
+        p.add_pipe({"match": {"hostname": {"conditions": [("exact", "Mail.Ru")]}},
+                    "alter": {"set": {"added": {"value": True}}}})
+        self.assertEqual(len(p.index.unindexed), 3)
+        self.assertTrue(p.process({"hostname": "mail.ru"})["added"])
+
+    def test_candidates(self):
+        p = Pipe(self.pipes, index=True)
+        self.assertTrue(isinstance(p.index, PipeIndex))
+        message = {
+            "username": "user5",
+            "text": "fork me on Github",
+            "created": "10:00:00",
+            "level": "1"
+        }
+        candidates = p.index.candidates(message)
+        self.assertEqual(len(candidates), 3)
+        self.assertEqual(candidates[0].spec["alter"], self.pipes[5]["alter"])
+        self.assertEqual(len(p.index.unindexed), 1)
+
+        res = p.process(copy(message))
+        self.assertEqual(res["text"], "fork me on user5")
+        self.assertTrue(res["forked"])
+        self.assertFalse("late" in res)
+
+        # conversion errors are left to pipes themselves.
+        message["level"] = None
+        self.assertRaises(TypeError, p.process, copy(message))
+
+    def test_process_same_as_without_index(self):
+        messages = [
+            {"username": "user1", "text": "hi Github", "created": "22:00:00", "level": 1},
+            {"username": "user2", "text": "fork", "created": "08:00:00", "level": 3},
+            {"username": "nobody", "text": "hi", "created": "22:00:00", "level": 2},
+            {"username": "nobody", "text": "Github", "created": "22:00:00", "level": "3"},
+        ]
+        indexed = Pipe(self.pipes, index=True)
+        plain = Pipe(self.pipes)
+        for message in messages:
+            self.assertEqual(
+                indexed.process(copy(message)), plain.process(copy(message)))
+        # first pipe changes username, so candidates are found again.
+        res = indexed.process(copy(messages[3]))
+        self.assertEqual(res["text"], "user7")
+        self.assertEqual(
+            list(indexed.process_many(messages)),
+            list(plain.process_many(messages))
+        )
+
+    def test_process_json(self):
+        messages = [
+            {"username": "user1", "text": "hi Github", "created": "22:00:00", "level": 1},
+            {"username": "nobody", "text": "hi", "created": "22:00:00", "level": 2},
+            {"username": "nobody", "text": "Github", "created": "22:00:00", "level": "3"},
+        ]
+        indexed = Pipe(self.pipes, index=True)
+        plain = Pipe(self.pipes)
+        for message in messages:
+            data = json.dumps(message)
+            res = indexed.process_json(data)
+            self.assertEqual(res, plain.process_json(data))
+            expected = plain.process(copy(message))
+            if expected == message:
+                self.assertTrue(res is data)
+            else:
+                self.assertEqual(json.loads(res), expected)
+
+    def test_update_pipes(self):
+        messages = [
+            {"username": "user1", "text": "hi Github", "created": "22:00:00", "level": 1},
+            {"username": "user2", "text": "fork", "created": "08:00:00", "level": 3},
+            {"username": "user5", "text": "Github fork", "created": "22:00:00", "level": 2},
+        ]
+        pipes = [dict(pipe, id=i) for i, pipe in enumerate(self.pipes)]
+        indexed = Pipe(pipes[:50], index=True)
+        plain = Pipe(pipes[:50])
+        old_index = indexed.index
+        old_candidates = old_index.candidates(copy(messages[2]))
+        for pipe in pipes[50:]:
+            indexed.add_pipe(pipe)
+            plain.add_pipe(pipe)
+        for pipe_id in range(0, 100, 3):
+            self.assertEqual(indexed.remove_pipe(pipe_id).id, pipe_id)
+            plain.remove_pipe(pipe_id)
+        replacement = {
+            "id": "fork",
+            "match": {"text": {"conditions": [("contains", "fork")]}},
+            "alter": {"set": {"forked": {"value": "yes"}}}
+        }
+        indexed.replace_pipe(100, replacement)
+        plain.replace_pipe(100, replacement)
+
+        expected = [
+            pipe for pipe in pipes
+            if (pipe["id"] % 3 or pipe["id"] > 100) and pipe["id"] != 100
+        ] + [replacement]
+        rebuilt = Pipe(expected)
+        self.assertEqual(
+            [pipe.id for pipe in indexed.pipes], [pipe.id for pipe in rebuilt.pipes])
+        for message in messages:
+            result = rebuilt.process(copy(message))
+            self.assertEqual(indexed.process(copy(message)), result)
+            self.assertEqual(plain.process(copy(message)), result)
+
+        # old index is not changed by updates.
+        self.assertEqual(old_index.candidates(copy(messages[2])), old_candidates)
+        self.assertRaises(KeyError, indexed.remove_pipe, 0)
+        self.assertRaises(ValueError, indexed.add_pipe, dict(replacement))
+
+    def test_invalid_update_changes_nothing(self):
+        pipes = [dict(pipe, id=i) for i, pipe in enumerate(self.pipes[:10])]
+        for options in ({}, {"index": True}):
+            p = Pipe(pipes, **options)
+            before = (p.pipes, dict(p.pipe_order), dict(p.pipe_ids), p.index)
+            removed = p.get_pipe(1)
+            added = p.compile(dict(pipes[0], id="new"))
+            self.assertRaises(ValueError, p.update_pipes, [added], [removed, removed])
+            self.assertRaises(ValueError, p.update_pipes, [added, added], [removed])
+            self.assertEqual((p.pipes, p.pipe_order, p.pipe_ids, p.index), before)
+            self.assertTrue(p.remove_pipe(1) is removed)
+            self.assertEqual(len(p.pipes), 9)
+            self.assertEqual(set(p.pipe_order), set(p.pipes))
+
+    def test_shared_between_threads(self):
+        pipes = [dict(pipe, id=i) for i, pipe in enumerate(self.pipes)]
+        replacement = {
+            "id": 0,
+            "match": {"text": {"conditions": [("icontains", "github")]}},
+            "alter": {"set": {"replaced": {"value": True}}}
+        }
+        message = {"username": "user0", "text": "hi Github", "created": "22:00:00", "level": 1}
+        shared = Pipe(pipes, index=True, copy_on_write=True)
+        expected = [
+            Pipe(pipes).process(copy(message)),
+            Pipe([replacement] + pipes[1:]).process(copy(message))
+        ]
+        errors = []
+        results = []
+
+        def read():
+            try:
+                for _ in range(200):
+                    results.append(shared.process(message))
+            except Exception as e:
+                errors.append(e)
+
+        def write():
+            try:
+                for i in range(100):
+                    shared.replace_pipe(0, replacement if i % 2 == 0 else pipes[0])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 800)
+        # every object is processed by old or new pipes, never by mix.
+        for result in results:
+            self.assertTrue(result in expected)
+        self.assertTrue(isinstance(shared.pipes, tuple))
+
+
+class FanOutTest(TestCase):
+
+    def setUp(self):
+        self.message = {
+            "username": "fzambia",
+            "text": "please, fork me on Github!",
+            "created": "21:40:39",
+            "tags": []
+        }
+        self.night = {
+            "match": {
+                "created": {
+                    "mode": "or",
+                    "conditions": [["lte", "09:00:00"], ["gte", "21:00:00"]],
+                    "type": "time"
+                },
+                "text": {"conditions": [["icontains", "Github"]]}
+            },
+            "alter": {"drop": "ALL"}
+        }
+        self.bitbucket = {
+            "match": {"username": {"conditions": [["exact", "fzambia"]]}},
+            "alter": {
+                "replace": {"text": {"value": "Github", "replacement": "Bitbucket"}},
+                "append": {"tags": {"value": "replaced"}}
+            }
+        }
+        self.nothing = {
+            "match": {"username": {"conditions": [["exact", "nobody"]]}},
+            "alter": {"drop": "ALL"}
+        }
+
+    def test_process(self):
+        fanout = FanOut(Pipe(), {
+            "alice": [self.night],
+            "bob": [self.bitbucket],
+            "carol": [json.dumps(self.bitbucket), self.nothing],
+            "dave": [],
+            "eve": Pipe([self.nothing])
+        })
+        original = copy(self.message)
+        results = fanout.process(self.message)
+        self.assertEqual(self.message, original)
+        self.assertEqual(results["alice"], None)
+        self.assertEqual(results["bob"]["text"], "please, fork me on Bitbucket!")
+        self.assertEqual(results["bob"]["tags"], ["replaced"])
+        # identical outcomes share result object.
+        self.assertTrue(results["bob"] is results["carol"])
+        self.assertTrue(results["dave"] is self.message)
+        self.assertTrue(results["eve"] is self.message)
+        self.assertTrue(fanout.subscribers["bob"][0] is fanout.subscribers["carol"][0])
+
+        fanout.unsubscribe("alice")
+        self.assertEqual(sorted(fanout.process(None)), ["bob", "carol", "dave", "eve"])
+
+    def test_matches_once_per_state(self):
+        calls = []
+
+        class CountingPipe(Pipe):
+            def make_match_exact(self, obj_value, condition_value):
+                calls.append(obj_value)
+                return obj_value == condition_value
+
+        subscribers = dict(("user%d" % i, [self.bitbucket]) for i in range(100))
+        fanout = FanOut(CountingPipe(), subscribers)
+        results = fanout.process(self.message)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(id(result) for result in results.values())), 1)
+
+
+class ColumnarPipeTest(TestCase):
+
+    def setUp(self):
+        self.records = [
+            {"hostname": "mail.ru", "protocol": "http", "status": 1,
+             "message": "critical error", "created": "2012-01-01 10:00", "repeats": 100},
+            {"hostname": "Google.COM", "protocol": "https", "status": 0,
+             "message": "critical warning", "created": "2012-01-02 22:00", "repeats": 5},
+            {"hostname": "example.org", "protocol": "http", "status": 1,
+             "message": "info", "created": "2012-01-01 10:00", "repeats": 50},
+            {"hostname": "mail.ru", "protocol": "ftp", "status": 2,
+             "message": "critical", "created": "2012-01-03 01:00", "repeats": 500},
+        ]
+        self.pipes = [
+            {
+                "priority": 1,
+                "match": {
+                    "hostname": {"mode": "or", "conditions": [["endswith", ".ru"], ["iendswith", ".com"]]},
+                    "protocol": {"conditions": [["startswith", "http"]]}
+                },
+                "alter": {
+                    "set": {"status": {"value": "2", "type": "int"}},
+                    "replace": {"message": {"value": "critical", "replacement": "info"}},
+                    "incr": {"repeats": {"value": 1}}
+                }
+            },
+            {
+                "priority": 2,
+                "mode": "or",
+                "match": {
+                    "created": {"conditions": [["gte", "2012-01-03 00:00"]], "type": "datetime"},
+                    "repeats": {"conditions": [["lt", 10]]}
+                },
+                "alter": {"drop": "ALL"}
+            },
+            {
+                "priority": 3,
+                "match": {"message": {"conditions": [["regex", "^info"]]}},
+                "alter": {"append": {"message": {"value": "!"}}}
+            }
+        ]
+
+    def check_process(self, use_numpy):
+        pipe = Pipe(self.pipes)
+        columns = to_columns(self.records)
+        original = to_columns(self.records)
+        result, kept = ColumnarPipe(pipe, use_numpy).process(columns)
+        self.assertEqual(columns, original)
+        expected = list(pipe.process_many(copy(record) for record in self.records))
+        self.assertEqual(to_records(result, kept), expected)
+        self.assertEqual(list(kept), [True, False, True, False])
+
+    def test_process_lists(self):
+        self.check_process(False)
+
+    @skipIf(columnar.numpy is None, "NumPy is not installed")
+    def test_process_numpy(self):
+        self.check_process(True)
+
+    def test_drop_keys(self):
+        pipe = Pipe([{
+            "match": {"status": {"conditions": [["exact", 1]]}},
+            "alter": {"drop": ["message"], "set": {"note": {"value": "x"}}}
+        }])
+        for use_numpy in (False, columnar.numpy is not None):
+            result, kept = ColumnarPipe(pipe, use_numpy).process(to_columns(self.records))
+            records = to_records(result, kept)
+            self.assertEqual([record["message"] for record in records],
+                             [None, "critical warning", None, "critical"])
+            self.assertEqual([record["note"] for record in records], ["x", None, "x", None])
+
+    def test_set_operators(self):
+        pipe = Pipe([{
+            "match": {
+                "hostname": {"conditions": [["in", ["mail.ru", "example.org"]]]},
+                "status": {"conditions": [["not_in", [2]]]}
+            },
+            "alter": {"drop": "ALL"}
+        }])
+        for use_numpy in (False, columnar.numpy is not None):
+            kept = ColumnarPipe(pipe, use_numpy).process(to_columns(self.records))[1]
+            self.assertEqual(list(kept), [False, True, False, True])
+
+    def test_equal_length(self):
+        self.assertRaises(ValueError, ColumnarPipe(Pipe(), False).process, {"a": [1], "b": [1, 2]})
+
+
+class PersistTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "pipes.cache")
+        self.pipes = [
+            json.dumps({
+                "match": {"status": {"conditions": [["exact", 1]]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            }),
+            {
+                "match": {"hostname": {"conditions": [["startswith", "mail"]]}},
+                "alter": {"set": {"status": {"value": 2}}}
+            }
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_content_hash(self):
+        key = persist.content_hash(self.pipes)
+        self.assertEqual(key, persist.content_hash(list(self.pipes)))
+        self.assertNotEqual(key, persist.content_hash(self.pipes[:1]))
+        self.assertNotEqual(key, persist.content_hash(self.pipes, ObjectPipe))
+        self.assertNotEqual(key, persist.content_hash(self.pipes, Pipe, {"index": True}))
+
+    def test_load_or_build(self):
+        obj = {"hostname": "mail.ru", "status": 1, "repeats": 1}
+        p = persist.load_or_build(self.path, self.pipes, index=True)
+        self.assertTrue(os.path.exists(self.path))
+        key = persist.content_hash(self.pipes, Pipe, {"index": True})
+        loaded = persist.load(self.path, key)
+        self.assertTrue(loaded is not None and loaded.index is not None)
+        self.assertEqual(loaded.process(dict(obj)), p.process(dict(obj)))
+        self.assertEqual(persist.load(self.path, persist.content_hash(self.pipes)), None)
+
+        # changed pipes rebuild cache.
+        p = persist.load_or_build(self.path, self.pipes[:1])
+        self.assertEqual(p.process(dict(obj))["status"], 1)
+        self.assertTrue(persist.load(self.path, persist.content_hash(self.pipes[:1])) is not None)
+
+        with open(self.path, "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(persist.load(self.path, key), None)
+        self.assertEqual(len(persist.load_or_build(self.path, self.pipes).pipes), 2)
+
+
+class ParallelPipeTest(TestCase):
+
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_process_many(self):
+        pipes = [
+            {
+                "match": {"status": {"conditions": [("exact", 1)]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            },
+            {
+                "match": {"repeats": {"conditions": [("gt", 150)]}},
+                "alter": {"drop": "ALL"}
+            }
+        ]
+        objects = [{"status": i % 2, "repeats": i} for i in range(200)]
+        expected = list(Pipe(pipes).process_many(copy(obj) for obj in objects))
+
+        with ParallelPipe(Pipe(pipes), processes=2, chunksize=16) as parallel:
+            results = list(parallel.process_many(objects))
+            self.assertEqual(results, expected)
+            # objects are processed in workers and not modified.
+            self.assertEqual(objects[1]["repeats"], 1)
+
+            results = list(parallel.process_many(
+                objects, chunksize=7, ordered=False, skip_none=True))
+            self.assertEqual(len(results), 151)
+            key = lambda obj: (obj["repeats"], obj["status"])
+            self.assertEqual(
+                sorted(results, key=key),
+                sorted([obj for obj in expected if obj is not None], key=key)
+            )
+
+
+@skipIf(AsyncPipe is None, "asyncio streaming requires Python 3.7+")
+class AsyncPipeTest(TestCase):
+
+    def setUp(self):
+        self.pipe = Pipe([
+            {
+                "match": {"status": {"conditions": [("exact", 0)]}},
+                "alter": {"drop": "ALL"}
+            },
+            {
+                "match": {"status": {"conditions": [("exact", 1)]}},
+                "alter": {"incr": {"repeats": {"value": 1}}}
+            }
+        ])
+        self.messages = [{"status": i % 3, "repeats": i} for i in range(50)]
+        self.expected = list(self.pipe.process_many(copy(m) for m in self.messages))
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_stream(self, async_pipe, **kwargs):
+        messages = [copy(m) for m in self.messages]
+        stream = async_pipe.process_stream(iterate(messages), **kwargs)
+        return self.loop.run_until_complete(collect(stream))
+
+    def test_process_stream(self):
+        async_pipe = AsyncPipe(self.pipe, batch_size=8)
+        self.assertEqual(self.run_stream(async_pipe), self.expected)
+        metrics = async_pipe.metrics()
+        self.assertEqual(metrics["batches"], 7)
+        self.assertEqual(metrics["objects"], 50)
+        self.assertEqual(metrics["dropped"], 17)
+        self.assertTrue(metrics["max_latency"] >= metrics["p50_latency"])
+
+    def test_process_stream_in_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(2)
+        try:
+            async_pipe = AsyncPipe(
+                self.pipe, batch_size=5, executor=executor, concurrency=2,
+                batch_timeout=1)
+            results = self.run_stream(async_pipe, skip_none=True)
+        finally:
+            executor.shutdown()
+        self.assertEqual(results, [obj for obj in self.expected if obj is not None])
+        self.assertEqual(async_pipe.metrics()["batches"], 10)
+
+    def slow_stream(self, messages, pause, events):
+        async def stream():
+            try:
+                for position, message in enumerate(messages):
+                    if position == 3:
+                        await asyncio.sleep(pause)
+                    events.append(("sent", position))
+                    yield message
+            finally:
+                events.append(("closed", None))
+        return stream()
+
+    def test_batch_timeout(self):
+        from concurrent.futures import ThreadPoolExecutor
+        messages = self.messages[:6]
+        expected = self.expected[:6]
+        executor = ThreadPoolExecutor(1)
+        try:
+            for options in ({}, {"executor": executor, "concurrency": 1}):
+                events = []
+                async_pipe = AsyncPipe(
+                    self.pipe, batch_size=10, batch_timeout=0.02, **options)
+
+                async def consume():
+                    stream = self.slow_stream([copy(m) for m in messages], 0.2, events)
+                    results = []
+                    async for obj in async_pipe.process_stream(stream):
+                        events.append(("got", len(results)))
+                        results.append(obj)
+                    return results
+
+                self.assertEqual(self.loop.run_until_complete(consume()), expected)
+                # messages before pause are flushed by timeout.
+                self.assertEqual(async_pipe.metrics()["batches"], 2)
+                self.assertTrue(events.index(("got", 2)) < events.index(("sent", 3)))
+        finally:
+            executor.shutdown()
+
+    def test_close_slow_stream(self):
+        events = []
+        async_pipe = AsyncPipe(self.pipe, batch_size=10, batch_timeout=0.01)
+
+        async def consume():
+            stream = async_pipe.process_stream(
+                self.slow_stream([copy(m) for m in self.messages], 60, events))
+            first = await stream.__anext__()
+            await stream.aclose()
+            # let cancelled stream finish.
+            await asyncio.sleep(0.01)
+            return first
+
+        started = self.loop.time()
+        self.assertEqual(self.loop.run_until_complete(consume()), self.expected[0])
+        self.assertTrue(self.loop.time() - started < 10)
+        # pending read of stream is cancelled.
+        self.assertEqual(events[-1], ("closed", None))
+
+
 if __name__ == '__main__':
     main()